@@ -1,27 +1,45 @@
 import os
 import io
+import csv
 import re
+import sys
 import base64
 import unicodedata
 import mimetypes
 import secrets
 import stripe
 import multiprocessing
+import threading
 import time
 import hashlib
 from flask_migrate import Migrate
 from io import BytesIO
-from functools import wraps
+from functools import lru_cache, wraps
 from contextlib import contextmanager
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Optional, Callable, cast
 from decimal import Decimal, InvalidOperation
 from datetime import datetime, timedelta, timezone, date
 from zoneinfo import ZoneInfo
 from uuid import uuid4
 import json
+import orjson
 import tempfile
 import requests
-from urllib.parse import urljoin
+try:
+    import redis
+except ImportError:  # pragma: no cover - cache em Redis só liga com redis instalado + REDIS_URL
+    redis = None
+try:
+    from flask_session import Session as FlaskSession
+except ImportError:  # pragma: no cover - sem flask-session a sessão fica no cookie assinado
+    FlaskSession = None
+from urllib.parse import urljoin, urlsplit, unquote
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
 from itsdangerous import URLSafeTimedSerializer, URLSafeSerializer, BadSignature, SignatureExpired
 from flask_mail import Mail, Message
 from dotenv import load_dotenv
@@ -38,25 +56,32 @@ from prescription import (
     send_reminder_patient,
     send_quote_whatsapp,
     send_text,
+    WHATSAPP_SESSION,
 )
 from exam_analyzer.pdf_extractor import extract_exam_payload, extract_bioresonancia_payload
 from exam_analyzer.ai import generate_ai_analysis, generate_bioresonancia_analysis
 from flask import (
     Flask, Blueprint, render_template, request, redirect, url_for,
-    session, flash, jsonify, abort, send_file, send_from_directory, g, current_app,
-    get_flashed_messages, stream_with_context
+    session, flash, jsonify, abort, send_file, g, current_app,
+    get_flashed_messages, stream_with_context, Response
 )
-from werkzeug.security import check_password_hash, generate_password_hash
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from werkzeug.utils import secure_filename
-from sqlalchemy import select, func, or_
+from sqlalchemy import select, insert, update, delete, func, or_, event, tuple_
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, contains_eager, joinedload, load_only, object_session, raiseload, selectinload
 from sqlalchemy.pool import NullPool
 from werkzeug.middleware.proxy_fix import ProxyFix
+from whitenoise import WhiteNoise
+from flask_compress import Compress
 from apscheduler.schedulers.background import BackgroundScheduler #type:ignore
 
 from models import (
     db, User, Patient, Doctor, Consult, PackageUsage,
-    Supplier, Product, AgendaEvent, Quote, QuoteResponse,
+    Supplier, Product, AgendaEvent, Quote, QuoteResponse, QuoteAnswer,
     SecureFile, PdfFile, WaitlistItem, ScheduledEmail,
     StockMovement, quote_suppliers, PatientExamHistory,
     Cashbox, CashboxTransaction, PatientPayment,
@@ -65,12 +90,36 @@ from models import (
 # ------------------------------------------------------------------------------
 # Inicialização / Config
 # ------------------------------------------------------------------------------
-app = Flask(__name__)
+class ORJSONProvider(DefaultJSONProvider):
+    """
+    jsonify / request.get_json via orjson (C). Mantém a saída do provider padrão:
+    chaves ordenadas, e datetime/Decimal etc. passam pelo default do Flask (http_date, str).
+    """
+    _OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
 
-if os.getenv("RENDER"):
-    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1)  # type: ignore
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=kwargs.get("default", self.default), option=self._OPTIONS).decode()
+
+    def loads(self, s: "str | bytes", **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        # bytes direto para o Response, sem o decode/encode de dumps()
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self._OPTIONS) + b"\n"
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+app = Flask(__name__)
+app.json = ORJSONProvider(app)
+# Cache de templates sem limite (o jinja_env é criado sob demanda, então vai nas opções)
+app.jinja_options = {**app.jinja_options, "cache_size": -1}
+# Sem stat() dos templates a cada render fora do modo debug
+app.config["TEMPLATES_AUTO_RELOAD"] = os.getenv("FLASK_DEBUG", "0").strip() == "1"
 
 app.config["SEND_FILE_MAX_AGE_DEFAULT"] = int(os.getenv("SEND_FILE_MAX_AGE_DEFAULT", "3600"))
+# Recusa uploads grandes antes de ler o corpo (413)
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_UPLOAD_MB", "50")) * 1024 * 1024
 
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'instance'))
 os.makedirs(BASE_DIR, exist_ok=True)
@@ -79,11 +128,69 @@ os.makedirs(STATIC_DIR, exist_ok=True)
 REACT_STATIC_DIR = os.path.join(STATIC_DIR, 'react')
 UPLOAD_FOLDER = os.path.join(STATIC_DIR, 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+PATIENT_UPLOAD_DIR = os.path.join(UPLOAD_FOLDER, 'patients')
+os.makedirs(PATIENT_UPLOAD_DIR, exist_ok=True)
+
+if os.getenv("RENDER"):
+    # /static servido pelo WhiteNoise antes do Flask (mesma política de cache do add_static_cache_headers:
+    # bundles com hash do Vite imutáveis por 1 ano, o resto 1 dia). Arquivo que não existia no boot
+    # (upload novo) segue para o Flask normalmente.
+    app.wsgi_app = WhiteNoise(  # type: ignore
+        app.wsgi_app,
+        root=STATIC_DIR,
+        prefix="static/",
+        max_age=86400,
+        immutable_file_test=lambda _path, url: url.startswith("/static/react/assets/"),
+    )
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1)  # type: ignore
+
+# Compressão das respostas do Flask (listas JSON das APIs, index.html); PDFs/arquivos via send_file ficam de fora
+app.config.update(
+    COMPRESS_MIMETYPES=["text/html", "application/json", "text/css", "application/javascript"],
+    COMPRESS_MIN_SIZE=1024,
+    # respostas em stream (ex.: /api/waitlist) não são comprimidas: o Flask-Compress chamaria
+    # get_data() e bufferizaria o corpo inteiro antes do primeiro byte
+    COMPRESS_STREAMS=False,
+)
+Compress(app)
+
+# Conteúdo dos SecureFile de imagem (fora de /static: só sai via rota autenticada)
+SECURE_STORAGE_DIR = os.getenv("SECURE_STORAGE_DIR") or os.path.join(BASE_DIR, 'secure_files')
+os.makedirs(SECURE_STORAGE_DIR, exist_ok=True)
+# Atrás do nginx: entrega os arquivos via X-Accel-Redirect (ex.: "/_protected/").
+#   location /_protected/ { internal; alias <SECURE_STORAGE_DIR>/; sendfile on; tcp_nopush on; }
+SECURE_ACCEL_PREFIX = (os.getenv("SECURE_ACCEL_PREFIX") or "").strip()
+# O disco do Render é efêmero e não é compartilhado entre instâncias: por padrão o blob no banco
+# continua sendo a cópia oficial e SECURE_STORAGE_DIR é só cache. SECURE_STORAGE_PERSISTENT=1 só
+# com disco persistente/compartilhado montado ali; aí o conteúdo novo não é duplicado no banco.
+SECURE_STORAGE_PERSISTENT = os.getenv("SECURE_STORAGE_PERSISTENT", "0").strip() == "1"
 
 SECRET_KEY = os.getenv("SECRET_KEY") or secrets.token_hex(32)
 app.config['SECRET_KEY'] = SECRET_KEY
 
-ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg'}
+# Redis (opcional): sessão no servidor + caches compartilhados entre workers
+REDIS_URL = (os.getenv("REDIS_URL") or "").strip()
+_redis = redis.Redis.from_url(REDIS_URL) if (redis is not None and REDIS_URL) else None
+
+if _redis is not None and FlaskSession is not None:
+    # Cookie leva só o id da sessão; o conteúdo fica no Redis (um GET por requisição)
+    app.config.update(
+        SESSION_TYPE="redis",
+        SESSION_REDIS=_redis,
+        SESSION_PERMANENT=False,
+        SESSION_USE_SIGNER=True,
+        SESSION_KEY_PREFIX="session:",
+    )
+    # O cookie continua de sessão do navegador, como no cookie assinado de antes. A chave no Redis
+    # precisa de TTL: sem SESSION_LIFETIME_SECONDS fica o padrão do Flask (31 dias), para ninguém
+    # ser deslogado no meio do expediente; encurtar é decisão de produto, via env.
+    if os.getenv("SESSION_LIFETIME_SECONDS"):
+        app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(seconds=int(os.getenv("SESSION_LIFETIME_SECONDS")))
+    FlaskSession(app)
+
+ALLOWED_EXTENSIONS = frozenset({'pdf', 'png', 'jpg', 'jpeg'})
+IMAGE_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg'})
+_IMAGE_MAGIC = ((b"\x89PNG\r\n\x1a\n", "image/png"), (b"\xff\xd8\xff", "image/jpeg"))
 DEFAULT_USER_IMAGE = "/static/images/user-icon.png"
 DEFAULT_PATIENT_IMAGE = "/static/images/user-icon.png"
 
@@ -109,18 +216,60 @@ app.config.update(
 
 mail = Mail(app)
 
+_REACT_INDEX_PATH = os.path.join(REACT_STATIC_DIR, "index.html")
+
+@lru_cache(maxsize=4)
+def _react_index_body(mtime_ns: int) -> tuple[bytes, str]:
+    """index.html + ETag em memória; a chave pelo mtime pega um build novo sem restart."""
+    with open(_REACT_INDEX_PATH, "rb") as fh:
+        body = fh.read()
+    return body, hashlib.sha1(body).hexdigest()
+
 def serve_react_index():
-    index_path = os.path.join(REACT_STATIC_DIR, "index.html")
-    if os.path.exists(index_path):
-        return send_from_directory(REACT_STATIC_DIR, "index.html")
-    return (
-        "React build not found. Run npm install and npm run build in templates/frontend.",
-        503,
-    )
+    try:
+        mtime_ns = os.stat(_REACT_INDEX_PATH).st_mtime_ns
+    except OSError:
+        return (
+            "React build not found. Run npm install and npm run build in templates/frontend.",
+            503,
+        )
+    body, etag = _react_index_body(mtime_ns)
+    # mesmos cabeçalhos que o send_from_directory gerava, sem abrir o arquivo a cada hit
+    resp = Response(body, mimetype="text/html")
+    resp.set_etag(etag)
+    resp.last_modified = mtime_ns / 1e9
+    max_age = app.config["SEND_FILE_MAX_AGE_DEFAULT"]
+    if max_age:
+        resp.cache_control.public = True
+        resp.cache_control.max_age = max_age
+    else:
+        resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
 
+_ALLOWED_SUFFIXES = tuple(f".{ext}" for ext in ALLOWED_EXTENSIONS)
+_ALLOWED_SUFFIX_MAXLEN = max(map(len, _ALLOWED_SUFFIXES))
 
 def allowed_file(filename: str) -> bool:
-    return bool(filename) and '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    # só a cauda do nome é normalizada (aceita "Exame.PDF", "foto.Jpg" etc.)
+    return (filename or "")[-_ALLOWED_SUFFIX_MAXLEN:].lower().endswith(_ALLOWED_SUFFIXES)
+
+
+def _image_ext_or_none(filename: Optional[str]) -> Optional[str]:
+    """Extensão (minúscula) se for imagem aceita; senão None."""
+    _, dot, ext = (filename or "").rpartition(".")
+    ext = ext.lower()
+    return ext if dot and ext in IMAGE_EXTENSIONS else None
+
+
+def _sniff_image_mime(file) -> Optional[str]:
+    """MIME pelos primeiros bytes (PNG/JPEG) em vez de confiar em file.mimetype."""
+    head = file.stream.read(8)
+    file.stream.seek(0)
+    for magic, mime in _IMAGE_MAGIC:
+        if head.startswith(magic):
+            return mime
+    return None
 
 
 TRIAL_EXEMPT_ENDPOINTS = {
@@ -205,7 +354,7 @@ def _serialize_admin_user(user: User) -> dict[str, Any]:
             return value.isoformat()
         return None
 
-    pkg = PackageUsage.query.filter_by(user_id=user.id).first()
+    pkg = user.package_usage
     pkg_total = _coerce_int(getattr(pkg, "total", DEFAULT_FREE_ANALYSIS_ALLOWANCE), default=DEFAULT_FREE_ANALYSIS_ALLOWANCE)
     pkg_used = _coerce_int(getattr(pkg, "used", 0))
     pkg_remaining = max(pkg_total - pkg_used, 0)
@@ -268,6 +417,9 @@ def _delete_user_account(user: User) -> None:
     quote_ids = [row[0] for row in db.session.query(Quote.id).filter(Quote.user_id == user_id).all()]
     if quote_ids:
         db.session.execute(quote_suppliers.delete().where(quote_suppliers.c.quote_id.in_(quote_ids)))
+        db.session.query(QuoteAnswer).filter(QuoteAnswer.quote_id.in_(quote_ids)).delete(
+            synchronize_session=False
+        )
         db.session.query(QuoteResponse).filter(QuoteResponse.quote_id.in_(quote_ids)).delete(
             synchronize_session=False
         )
@@ -276,6 +428,9 @@ def _delete_user_account(user: User) -> None:
     supplier_ids = [row[0] for row in db.session.query(Supplier.id).filter(Supplier.user_id == user_id).all()]
     if supplier_ids:
         db.session.execute(quote_suppliers.delete().where(quote_suppliers.c.supplier_id.in_(supplier_ids)))
+        db.session.query(QuoteAnswer).filter(QuoteAnswer.supplier_id.in_(supplier_ids)).delete(
+            synchronize_session=False
+        )
         db.session.query(QuoteResponse).filter(QuoteResponse.supplier_id.in_(supplier_ids)).delete(
             synchronize_session=False
         )
@@ -309,9 +464,28 @@ def _delete_user_account(user: User) -> None:
         db.session.query(PdfFile).filter(PdfFile.secure_file_id.in_(secure_file_ids)).delete(
             synchronize_session=False
         )
+        storage_paths = {
+            row[0]
+            for row in db.session.query(SecureFile.storage_path)
+            .filter(SecureFile.id.in_(secure_file_ids), SecureFile.storage_path.isnot(None))
+            .all()
+        }
         db.session.query(SecureFile).filter(SecureFile.id.in_(secure_file_ids)).delete(
             synchronize_session=False
         )
+        if storage_paths:
+            still_used = {
+                row[0]
+                for row in db.session.query(SecureFile.storage_path)
+                .filter(SecureFile.storage_path.in_(storage_paths))
+                .all()
+            }
+            for rel_path in storage_paths - still_used:
+                for path in (rel_path, _thumb_rel_path(rel_path)):
+                    try:
+                        os.remove(os.path.join(SECURE_STORAGE_DIR, path))
+                    except OSError:
+                        pass
 
     db.session.delete(user)
 
@@ -524,11 +698,12 @@ def _env_positive_int(keys: list[str], *, default: int) -> int:
 def _ensure_package_usage(user: User, *, base_total: Optional[int] = None) -> tuple[PackageUsage, bool]:
     """Garantir que o usuário possua registro de pacote com o mínimo configurado."""
     baseline = base_total if base_total is not None else DEFAULT_FREE_ANALYSIS_ALLOWANCE
-    pkg = PackageUsage.query.filter_by(user_id=user.id).first()
+    pkg = user.package_usage
     changed = False
 
     if not pkg:
         pkg = PackageUsage(user_id=user.id, total=baseline, used=0)
+        user.package_usage = pkg
         db.session.add(pkg)
         changed = True
     else:
@@ -560,8 +735,12 @@ def _analysis_package_status(user: User) -> tuple[PackageUsage, int]:
 
 def _consume_analysis_slot(pkg: PackageUsage) -> None:
     """Incrementa o uso de análises após uma execução bem-sucedida."""
-    pkg.used = _coerce_int(getattr(pkg, "used", 0)) + 1
-    db.session.add(pkg)
+    # incremento no banco: duas análises simultâneas não sobrescrevem o "used" uma da outra
+    db.session.execute(
+        update(PackageUsage)
+        .where(PackageUsage.id == pkg.id)
+        .values(used=func.coalesce(PackageUsage.used, 0) + 1)
+    )
     db.session.commit()
 
 
@@ -655,6 +834,13 @@ engine_options: dict[str, Any] = {
     "pool_recycle": 300,
 }
 
+if DATABASE_URL.startswith("postgresql+psycopg2://"):
+    # executemany (inserts/updates em lote) vira INSERT ... VALUES multi-linha / execute_batch
+    engine_options.update({
+        "executemany_mode": "values_plus_batch",
+        "executemany_values_page_size": 1000,
+    })
+
 if use_null_pool:
     reason = "forçado por DB_FORCE_NULLPOOL" if force_null_pool else "limite total <= workers"
     print(
@@ -689,9 +875,27 @@ app.config.update(
 db.init_app(app)
 migrate = Migrate(app, db)
 
+def _gevent_patched() -> bool:
+    """True dentro de um worker gevent do gunicorn (monkey.patch_all roda antes de importar o app)."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
 try:
-    _db_connection_semaphore = multiprocessing.BoundedSemaphore(available_db_clients)
-    print(f"[DB] Limite global de {available_db_clients} conexões simultâneas configurado.")
+    if _gevent_patched():
+        # multiprocessing.BoundedSemaphore não é "verde": o acquire() travaria a thread do hub e,
+        # com isso, os greenlets que seguram as vagas nunca as devolveriam. Aqui o limite é o do
+        # próprio pool do worker, então quem sobra espera no semáforo e não no pool_timeout.
+        from gevent.lock import BoundedSemaphore as _GeventBoundedSemaphore
+
+        _db_slot_limit = per_worker_budget if use_null_pool else effective_pool_size + effective_max_overflow
+        _db_connection_semaphore = _GeventBoundedSemaphore(max(_db_slot_limit, 1))
+        print(f"[DB] Limite de {max(_db_slot_limit, 1)} conexões simultâneas por worker (gevent).")
+    else:
+        _db_connection_semaphore = multiprocessing.BoundedSemaphore(available_db_clients)
+        print(f"[DB] Limite global de {available_db_clients} conexões simultâneas configurado.")
 except Exception as exc:
     _db_connection_semaphore = None
     print("[DB] ⚠️ Semáforo global de conexões indisponível:", exc)
@@ -759,6 +963,83 @@ def apply_minimal_migrations():
 # ------------------------------------------------------------------------------
 # Funções auxiliares de armazenamento de PDFs
 # ------------------------------------------------------------------------------
+@lru_cache(maxsize=1)
+def _weasy_font_config():
+    """FontConfiguration única por processo (evita refazer o cache de fontes a cada PDF)."""
+    from weasyprint.text.fonts import FontConfiguration
+    return FontConfiguration()
+
+PDF_CSS_DIR = os.path.join(STATIC_DIR, "css")
+
+@lru_cache(maxsize=None)
+def _weasy_stylesheet(filename: str):
+    """CSS dos templates de PDF compilado uma vez por processo (static/css/<filename>)."""
+    from weasyprint import CSS
+    return CSS(filename=os.path.join(PDF_CSS_DIR, filename), font_config=_weasy_font_config())
+
+# <link> para CSS de bundle/bootstrap não é usado nos PDFs e só custa parse no WeasyPrint
+_PDF_BUNDLE_LINK_RE = re.compile(r'<link[^>]+href="[^"]*(?:bundle|bootstrap)[^"]*"[^>]*>', re.IGNORECASE)
+
+def _weasy_local_fetcher(url: str) -> dict[str, Any]:
+    """
+    url_fetcher do WeasyPrint que não sai para a rede: /static/... (inclusive na URL pública
+    do próprio app, usada no logo) é lido do disco; data:/file: dentro do app passam; o resto é recusado.
+    """
+    from weasyprint import default_url_fetcher
+    parts = urlsplit(url)
+    if parts.scheme == "data":
+        return default_url_fetcher(url)
+    if parts.scheme == "file":
+        abs_path = os.path.realpath(unquote(parts.path))
+    elif parts.scheme in ("http", "https") and parts.path.startswith("/static/"):
+        abs_path = os.path.realpath(os.path.join(STATIC_DIR, unquote(parts.path[len("/static/"):])))
+    else:
+        raise ValueError(f"URL externa bloqueada no PDF: {url}")
+    if not abs_path.startswith(os.path.realpath(app.root_path) + os.sep) or not os.path.isfile(abs_path):
+        raise ValueError(f"Arquivo fora do app bloqueado no PDF: {url}")
+    with open(abs_path, "rb") as fh:
+        return {
+            "string": fh.read(),
+            "mime_type": mimetypes.guess_type(abs_path)[0],
+            "filename": os.path.basename(abs_path),
+        }
+
+# Assets (<img src>, <link href>) referenciados no HTML do PDF
+_PDF_ASSET_RE = re.compile(r'<(?:img|link)\b[^>]*?\b(?:src|href)="([^"]+)"', re.IGNORECASE)
+_PDF_ASSET_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="pdf-assets")
+
+def _weasy_prefetching_fetcher(html_str: str):
+    """
+    Lê em paralelo os assets do HTML e devolve um url_fetcher que os serve da memória;
+    URLs não previstas (ou que falharam) caem no _weasy_local_fetcher normal.
+    """
+    base = Path(current_app.root_path).as_uri() + "/"
+    urls = {urljoin(base, src) for src in _PDF_ASSET_RE.findall(html_str) if not src.startswith("data:")}
+
+    def _try_fetch(url: str):
+        try:
+            return url, _weasy_local_fetcher(url)
+        except (OSError, ValueError):
+            return url, None
+
+    prefetched = {url: res for url, res in _PDF_ASSET_EXECUTOR.map(_try_fetch, urls) if res is not None}
+
+    def _fetcher(url: str) -> dict[str, Any]:
+        res = prefetched.get(url)
+        return dict(res) if res is not None else _weasy_local_fetcher(url)
+
+    return _fetcher
+
+def _weasy_html(html_str: str):
+    """HTML do WeasyPrint com o HTML limpo (sem CSS de bundle) e assets locais pré-carregados."""
+    from weasyprint import HTML
+    html_str = _PDF_BUNDLE_LINK_RE.sub("", html_str)
+    return HTML(
+        string=html_str,
+        base_url=current_app.root_path,
+        url_fetcher=_weasy_prefetching_fetcher(html_str),
+    )
+
 def _save_pdf_bytes_to_db(*, user_id: int, patient_id: Optional[int], consult_id: Optional[int],
                           original_name: str, data: bytes, kind: str) -> int:
     """
@@ -788,6 +1069,52 @@ def _save_pdf_bytes_to_db(*, user_id: int, patient_id: Optional[int], consult_id
     db.session.commit()
     return pf.id
 
+# Gravação dos blobs de PDF fora da requisição: o usuário recebe o arquivo sem esperar o INSERT
+_PDF_SAVE_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pdf-save")
+
+def _latest_consult_id(patient_id: int) -> Optional[int]:
+    """Consulta mais recente do paciente (à qual os PDFs gerados fora do /download_pdf são vinculados)."""
+    return db.session.scalar(
+        select(Consult.id)
+        .where(Consult.patient_id == patient_id)
+        .order_by(Consult.date.desc())
+        .limit(1)
+    )
+
+def _save_pdf_bytes_in_background(**kwargs: Any) -> None:
+    """
+    Agenda o _save_pdf_bytes_to_db (mesmos kwargs, consult_id já resolvido pelo chamador)
+    num app context próprio; falhas só vão pro log.
+    """
+    _PDF_SAVE_EXECUTOR.submit(_save_pdf_bytes_job, kwargs)
+
+def _save_pdf_bytes_job(kwargs: dict[str, Any]) -> None:
+    with db_slot_guard(), app.app_context():
+        try:
+            _save_pdf_bytes_to_db(**kwargs)
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception("[PDF] erro ao salvar %s no DB", kwargs.get("kind"))
+
+def _save_pdf_file_in_background(path: str, **kwargs: Any) -> None:
+    """Igual ao _save_pdf_bytes_in_background, mas lê o PDF de `path` e apaga o temporário."""
+    _PDF_SAVE_EXECUTOR.submit(_save_pdf_file_job, path, kwargs)
+
+def _save_pdf_file_job(path: str, kwargs: dict[str, Any]) -> None:
+    try:
+        with open(path, "rb") as fh:
+            kwargs["data"] = fh.read()
+    except OSError:
+        app.logger.exception("[PDF] erro ao ler %s temporário", kwargs.get("kind"))
+        return
+    finally:
+        # a resposta já tem o arquivo aberto; no Linux o unlink não interrompe o download
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    _save_pdf_bytes_job(kwargs)
+
 
 def _resolve_public_logo_url(filename: str) -> str:
     public_base = current_app.config.get("PUBLIC_BASE_URL")
@@ -819,7 +1146,9 @@ def _serve_pdf_from_db(pdf_file_id: int, *, download_name: Optional[str] = None)
     Envia um PDF armazenado no banco (verifica o owner antes).
     """
     u = current_user()
-    pf = PdfFile.query.get_or_404(pdf_file_id)
+    pf = db.session.get(PdfFile, pdf_file_id, options=[joinedload(PdfFile.secure_file).undefer(SecureFile.data)])
+    if not pf:
+        abort(404)
     sf = pf.secure_file
     if not sf or (sf.user_id is not None and sf.user_id != u.id):
         abort(403)
@@ -965,12 +1294,11 @@ def brt(dt):
 
     # Handle strings
     if isinstance(dt, str):
-        for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%Y/%m/%d"):
-            try:
-                dt = datetime.strptime(dt, fmt)
-                break
-            except ValueError:
-                continue
+        # cobre "%Y-%m-%d %H:%M:%S", "%Y-%m-%d" e "%Y/%m/%d" sem laço de strptime
+        try:
+            dt = datetime.fromisoformat(dt.replace("/", "-"))
+        except ValueError:
+            pass
 
     # Handle datetime
     if isinstance(dt, datetime):
@@ -994,28 +1322,302 @@ def url_helpers():
         return url_for("static", filename=p)
     return {"img_url": img_url}
 
+_SECUREFILE_URL_RE = re.compile(r"/files/img/(\d+)")
+
 def _extract_securefile_id_from_url(url: str) -> Optional[int]:
+    m = _SECUREFILE_URL_RE.search(url or "")
+    return int(m.group(1)) if m else None
+
+_STREAM_CHUNK = 64 * 1024
+
+def _store_secure_stream(stream, ext: str) -> tuple[str, str, int]:
+    """
+    Copia o stream em blocos de 64KB para SECURE_STORAGE_DIR/<sha[:2]>/<sha>.<ext>,
+    calculando sha256 e tamanho no mesmo laço (nunca materializa o arquivo inteiro).
+    Retorna (sha256, caminho relativo, tamanho).
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    tmp_path = os.path.join(SECURE_STORAGE_DIR, f".upload_{uuid4().hex}.tmp")
     try:
-        m = re.search(r"/files/img/(\d+)", (url or "").strip())
-        return int(m.group(1)) if m else None
-    except Exception:
+        with open(tmp_path, "wb") as out:
+            while True:
+                chunk = stream.read(_STREAM_CHUNK)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        digest = hasher.hexdigest()
+        rel_path = f"{digest[:2]}/{digest}.{ext.lower().lstrip('.')}"
+        abs_path = os.path.join(SECURE_STORAGE_DIR, rel_path)
+        if size and not os.path.exists(abs_path):
+            os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+            os.replace(tmp_path, abs_path)
+        return digest, rel_path, size
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _store_secure_bytes(data: bytes, ext: str) -> tuple[str, str]:
+    """Versão para conteúdo já em memória. Retorna (sha256, caminho relativo)."""
+    digest, rel_path, _ = _store_secure_stream(BytesIO(data), ext)
+    return digest, rel_path
+
+def _secure_db_copy(rel_path: str, content: Optional[bytes] = None) -> Optional[bytes]:
+    """Conteúdo para SecureFile.data (cópia durável no banco); None só com SECURE_STORAGE_PERSISTENT."""
+    if SECURE_STORAGE_PERSISTENT:
+        return None
+    if content is not None:
+        return content
+    with open(os.path.join(SECURE_STORAGE_DIR, rel_path), "rb") as fh:
+        return fh.read()
+
+def _ensure_secure_file_on_disk(sf) -> Optional[str]:
+    """
+    Caminho absoluto do conteúdo em disco; se o arquivo sumiu (restart/outra instância),
+    regrava a partir do blob no banco. None se não houver nem arquivo nem blob.
+    """
+    abs_path = _securefile_abspath(sf)
+    if not abs_path:
+        return None
+    if os.path.exists(abs_path):
+        return abs_path
+    data = db.session.scalar(select(SecureFile.data).where(SecureFile.id == sf.id))
+    if not data:
+        return None
+    try:
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+        tmp_path = f"{abs_path}.{uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp_path, abs_path)
+    except OSError as e:
+        print("[secure_file] erro ao regravar arquivo do blob:", e)
+        return None
+    return abs_path
+
+_THUMB_SIZE = (256, 256)
+
+def _thumb_rel_path(rel_path: str) -> str:
+    return f"{os.path.splitext(rel_path)[0]}_thumb.webp"
+
+def _make_secure_thumbnail(rel_path: str) -> Optional[str]:
+    """
+    Gera (uma vez, no upload) a miniatura 256x256 WEBP ao lado do original.
+    Retorna o caminho relativo da miniatura, ou None se não for possível.
+    """
+    from PIL import Image, ImageOps
+
+    thumb_rel = _thumb_rel_path(rel_path)
+    thumb_abs = os.path.join(SECURE_STORAGE_DIR, thumb_rel)
+    if os.path.exists(thumb_abs):
+        return thumb_rel
+    try:
+        with Image.open(os.path.join(SECURE_STORAGE_DIR, rel_path)) as src:
+            # JPEG: decodifica já reduzido (bem mais barato que abrir em resolução cheia)
+            src.draft("RGB", (_THUMB_SIZE[0] * 2, _THUMB_SIZE[1] * 2))
+            # o WEBP não leva o EXIF: aplica a Orientation antes, senão foto de celular sai girada
+            thumb = ImageOps.exif_transpose(src)
+            thumb.thumbnail(_THUMB_SIZE)
+            if thumb.mode not in ("RGB", "RGBA"):
+                thumb = thumb.convert("RGBA" if "A" in thumb.getbands() else "RGB")
+            tmp_path = f"{thumb_abs}.{uuid4().hex}.tmp"
+            thumb.save(tmp_path, format="WEBP", quality=80)
+        os.replace(tmp_path, thumb_abs)
+        return thumb_rel
+    except Exception as e:
+        print("[thumb] erro ao gerar miniatura:", e)
+        return None
+
+def _downscale_profile_image(content: bytes) -> Optional[bytes]:
+    """
+    Foto de perfil reduzida para 256x256 e recodificada em WEBP antes de ir para o storage
+    (o avatar é servido em toda página; o original de celular tem vários MB). None se falhar.
+    """
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(BytesIO(content)) as src:
+            src.draft("RGB", (_THUMB_SIZE[0] * 2, _THUMB_SIZE[1] * 2))
+            # o WEBP não leva o EXIF: aplica a Orientation antes, senão foto de celular sai girada
+            avatar = ImageOps.exif_transpose(src)
+            avatar.thumbnail(_THUMB_SIZE)
+            if avatar.mode not in ("RGB", "RGBA"):
+                avatar = avatar.convert("RGBA" if "A" in avatar.getbands() else "RGB")
+            out = BytesIO()
+            avatar.save(out, format="WEBP", quality=82, method=6)
+        return out.getvalue()
+    except Exception as e:
+        print("[profile] erro ao reduzir foto de perfil:", e)
+        return None
+
+def _securefile_abspath(sf) -> Optional[str]:
+    """Caminho absoluto do conteúdo em disco, ou None se o SecureFile ainda é blob no banco."""
+    rel_path = getattr(sf, "storage_path", None)
+    if not rel_path:
+        return None
+    abs_path = os.path.realpath(os.path.join(SECURE_STORAGE_DIR, rel_path))
+    if not abs_path.startswith(os.path.realpath(SECURE_STORAGE_DIR) + os.sep):
         return None
+    return abs_path
+
+def _accel_redirect_response(rel_path: str, mimetype: str, *, etag: Optional[str] = None,
+                             last_modified: Optional[datetime] = None) -> Response:
+    """Resposta vazia com X-Accel-Redirect: o nginx envia o arquivo e o worker fica livre."""
+    resp = Response(status=200, mimetype=mimetype)
+    resp.headers["X-Accel-Redirect"] = SECURE_ACCEL_PREFIX.rstrip("/") + "/" + rel_path.lstrip("/")
+    if etag:
+        resp.set_etag(etag)
+    if last_modified:
+        resp.last_modified = last_modified
+    resp.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    return resp
+
+def _remove_secure_storage(sf) -> None:
+    """Apaga o arquivo em disco se nenhum outro SecureFile aponta para ele."""
+    abs_path = _securefile_abspath(sf)
+    if not abs_path:
+        return
+    still_used = db.session.scalar(
+        select(SecureFile.id).where(SecureFile.storage_path == sf.storage_path, SecureFile.id != sf.id).limit(1)
+    )
+    if still_used is None:
+        for path in (abs_path, os.path.join(SECURE_STORAGE_DIR, _thumb_rel_path(sf.storage_path))):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print("[secure_file] remove error:", e)
 
 def _delete_securefile_if_owned(file_id: int, user_id: int):
     try:
         sf = SecureFile.query.get(file_id)
         if sf and (sf.user_id is None or sf.user_id == user_id):
+            _remove_secure_storage(sf)
             db.session.delete(sf)
             db.session.commit()
     except Exception:
         db.session.rollback()
 
+def _sqlite_without_fk_cascade() -> bool:
+    """SQLite (fallback local) não aplica ON DELETE CASCADE sem PRAGMA foreign_keys."""
+    return db.engine.dialect.name == "sqlite"
+
+def _json_response(payload: Any, status: int = 200) -> Response:
+    """JSON direto via orjson: datetime/date saem em ISO 8601 sem .isoformat() manual."""
+    return Response(orjson.dumps(payload, default=app.json.default), status=status, mimetype="application/json")
+
+def _owned_or_404(model, obj_id: int, user: Optional[User] = None, *, options: tuple = ()):
+    """Busca o registro já filtrado pelo dono (uma query só); 404 se não existir ou for de outro usuário."""
+    user = user or current_user()
+    return model.query.options(*options).filter_by(id=obj_id, user_id=user.id).first_or_404()
+
+# ------------------------------------------------------------------------------
+# Cache do usuário logado (Redis, opcional)
+# ------------------------------------------------------------------------------
+# Sem REDIS_URL cada requisição busca o usuário no banco, como antes.
+# Só colunas escalares usadas pelo login_required/context processor vão para o Redis,
+# em JSON; PackageUsage fica de fora. Quem precisa gravar ou ler relações chama
+# current_user(), que sempre carrega o User do banco.
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "120"))
+_USER_CACHE_FIELDS = (
+    "id", "username", "email", "name", "profile_image",
+    "plan", "plan_status", "plan_expiration", "trial_expiration",
+)
+_USER_CACHE_DATETIMES = ("plan_expiration", "trial_expiration")
+
+
+class _CachedUser:
+    """Visão só-leitura do usuário logado montada do Redis (fora da sessão, sem relações)."""
+    __slots__ = _USER_CACHE_FIELDS
+
+    def __init__(self, data: dict[str, Any]) -> None:
+        for key in _USER_CACHE_FIELDS:
+            value = data.get(key)
+            if key in _USER_CACHE_DATETIMES and value:
+                value = datetime.fromisoformat(value)
+            setattr(self, key, value)
+
+    @property
+    def display_name(self) -> str:
+        return self.name or self.username
+
+
+def _user_cache_key(uid: int) -> str:
+    return f"user:{uid}"
+
+def _user_cache_gen_key(uid: int) -> str:
+    return f"user:{uid}:gen"
+
+def _user_cache_get(uid: int) -> tuple[Optional[_CachedUser], int]:
+    """(visão em cache, geração atual); a visão só vale se foi gravada na geração atual."""
+    if _redis is None:
+        return None, 0
+    try:
+        gen_raw, raw = _redis.mget(_user_cache_gen_key(uid), _user_cache_key(uid))
+        gen = int(gen_raw or 0)
+        if raw is None:
+            return None, gen
+        data = orjson.loads(raw)
+        if data.get("_gen") != gen:
+            return None, gen
+        return _CachedUser(data), gen
+    except Exception as e:
+        print("[CACHE] falha ao ler usuário do Redis:", e)
+        return None, 0
+
+def _user_cache_set(u: User, gen: int) -> None:
+    # gen foi lida ANTES do SELECT: se um commit invalidou o usuário no meio tempo,
+    # a geração já avançou e o valor gravado aqui nunca é aceito na leitura.
+    if _redis is None:
+        return
+    data = {key: getattr(u, key) for key in _USER_CACHE_FIELDS}
+    data["_gen"] = gen
+    try:
+        _redis.setex(_user_cache_key(u.id), USER_CACHE_TTL, orjson.dumps(data))
+    except Exception as e:
+        print("[CACHE] falha ao gravar usuário no Redis:", e)
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _mark_user_cache_stale(_mapper, _conn, target) -> None:
+    # Invalida só depois do commit: antes disso outra requisição ainda leria o valor antigo do banco.
+    sess = object_session(target)
+    if sess is not None:
+        sess.info.setdefault("_stale_user_ids", set()).add(target.id)
+
+@event.listens_for(Session, "after_commit")
+def _drop_stale_user_cache(sess: Session) -> None:
+    stale = sess.info.pop("_stale_user_ids", None)
+    if stale and _redis is not None:
+        try:
+            pipe = _redis.pipeline(transaction=False)
+            for uid in stale:
+                pipe.incr(_user_cache_gen_key(uid))
+                pipe.expire(_user_cache_gen_key(uid), 86400)
+                pipe.delete(_user_cache_key(uid))
+            pipe.execute()
+        except Exception as e:
+            print("[CACHE] falha ao invalidar usuário no Redis:", e)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_stale_user_cache(sess: Session) -> None:
+    sess.info.pop("_stale_user_ids", None)
+
 def get_logged_user() -> Optional[User]:
     uid = session.get('user_id')
     if not uid:
         return None
+    # memoiza por requisição (current_user e o context processor chamam isto)
+    cached = g.get("_logged_user")
+    if cached is not None and cached[0] == uid:
+        return cached[1]
     try:
-        return User.query.get(uid)
+        u = User.query.get(uid)
+        g._logged_user = (uid, u)
+        return u
     except OperationalError as oe:
         # DB is unavailable (connection refused / network issue). Return None so
         # login_required and other callers can handle an unauthenticated user
@@ -1034,6 +1636,26 @@ def get_logged_user() -> Optional[User]:
             pass
         return None
 
+def _logged_user_view() -> Optional[Any]:
+    """Usuário logado para checagens de acesso: visão do Redis se houver, senão o User do banco."""
+    uid = session.get('user_id')
+    if not uid:
+        return None
+    cached = g.get("_logged_user")
+    if cached is not None and cached[0] == uid:
+        return cached[1]
+    view = g.get("_logged_user_view")
+    if view is not None and view.id == uid:
+        return view
+    view, gen = _user_cache_get(uid)
+    if view is not None:
+        g._logged_user_view = view
+        return view
+    u = get_logged_user()
+    if u is not None:
+        _user_cache_set(u, gen)
+    return u
+
 def _request_wants_json() -> bool:
     """Detecta se a requisição espera uma resposta JSON (fetch/API)."""
     if request.is_json:
@@ -1057,10 +1679,9 @@ def login_required(f: Callable[..., Any]) -> Callable[..., Any]:
     """
     @wraps(f)
     def wrapper(*args, **kwargs):
-        u = get_logged_user()
+        u = _logged_user_view()
         if not u:
             return redirect(url_for('login'))
-        g.user = u
         if _is_admin_user(u):
             return f(*args, **kwargs)
 
@@ -1102,40 +1723,81 @@ def login_required(f: Callable[..., Any]) -> Callable[..., Any]:
     return wrapper
 
 def current_user() -> User:
-    u = getattr(g, "user", None) or get_logged_user()
-    if not u:
-        abort(401)
+    u = getattr(g, "user", None)
+    if u is None:
+        u = get_logged_user()
+        if not u:
+            abort(401)
+        g.user = u
     return cast(User, u)
 
+# ------------------------------------------------------------------------------
+# Senhas: argon2id. Hashes antigos do Werkzeug (pbkdf2:...) continuam válidos e
+# são regravados em argon2 no próximo login bem-sucedido.
+# ------------------------------------------------------------------------------
+# Parâmetros mínimos recomendados pela OWASP (19 MiB, 2 iterações): bem mais barato
+# por login que o PBKDF2 de 600k iterações, e o hash cabe em users.password_hash (128)
+_PASSWORD_HASHER = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+def _hash_password(password: str) -> str:
+    return _PASSWORD_HASHER.hash(password)
+
+def _verify_password(stored_hash: str, password: str) -> tuple[bool, bool]:
+    """(senha confere, hash precisa ser regravado)."""
+    if not stored_hash.startswith("$argon2"):
+        return check_password_hash(stored_hash, password), True
+    try:
+        _PASSWORD_HASHER.verify(stored_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False, False
+    return True, _PASSWORD_HASHER.check_needs_rehash(stored_hash)
+
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
 def basic_email(email: str) -> bool:
-    return bool(re.match(r"^[^@\s]+@[^@\s]+\.[^@\s]+$", email))
+    return _EMAIL_RE.match(email) is not None
 
 def user_exists(sess, username: Optional[str] = None, email: Optional[str] = None) -> Optional[str]:
+    """
+    "username"/"email" conforme o que já está em uso (username tem prioridade), ou None.
+    Um único SELECT com OR; o e-mail é comparado sem diferenciar maiúsculas.
+    """
+    conds = []
     if username:
-        if sess.execute(select(User.id).where(User.username == username)).scalar():
-            return "username"
+        conds.append(User.username == username)
     if email:
-        if sess.execute(select(User.id).where(User.email == email)).scalar():
-            return "email"
+        conds.append(func.lower(User.email) == email.lower())
+    if not conds:
+        return None
+    rows = sess.execute(select(User.username, User.email).where(or_(*conds)).limit(2)).all()
+    if username and any(r.username == username for r in rows):
+        return "username"
+    if rows:
+        return "email"
     return None
 
+# Regras de senha do cadastro
+_PW_UPPER_RE = re.compile(r"[A-Z]")
+_PW_DIGIT_RE = re.compile(r"\d")
+_PW_SPECIAL_RE = re.compile(r"[!@#$%^&*(),.?\":{}|<>_+=\-]")
+
 def _register_validation_error(username: str, email: str, password: str, confirm: str) -> Optional[str]:
     if len(password) < 8:
         return "A senha deve ter pelo menos 8 caracteres."
-    if not re.search(r"[A-Z]", password):
+    if not _PW_UPPER_RE.search(password):
         return "A senha deve conter pelo menos uma letra maiuscula."
-    if not re.search(r"\d", password):
+    if not _PW_DIGIT_RE.search(password):
         return "A senha deve conter pelo menos um número."
-    if not re.search(r"[!@#$%^&*(),.?\":{}|<>_+=\-]", password):
+    if not _PW_SPECIAL_RE.search(password):
         return "A senha deve conter pelo menos um caractere especial."
     if password != confirm:
         return "As senhas não coincidem."
     if not username:
         return "Informe um nome de usuario."
-    if User.query.filter_by(username=username).first():
+    taken = user_exists(db.session, username=username, email=email)
+    if taken == "username":
         return "Este nome de usuario ja esta em uso."
-    existing_email = User.query.filter(func.lower(User.email) == email.lower()).first()
-    if existing_email:
+    if taken == "email":
         return "Este e-mail ja esta cadastrado."
     return None
 
@@ -1155,7 +1817,7 @@ def _process_register(payload: dict[str, Any]) -> tuple[bool, str]:
         {
             "username": username,
             "email": email,
-            "password_hash": generate_password_hash(password),
+            "password_hash": _hash_password(password),
             "plan": plan,
         },
         salt="email-confirm",
@@ -1208,10 +1870,14 @@ WhatsApp: +55 33 98461-3689
 
 @app.context_processor
 def inject_user_context():
-    u = getattr(g, "user", None) or get_logged_user()
+    # montado uma vez por requisição (base + partials + e-mails renderizam várias vezes)
+    ctx = g.get("_user_ctx")
+    if ctx is not None:
+        return ctx
+    u = getattr(g, "user", None) or _logged_user_view()
     if not u:
         return {}
-    return {
+    ctx = {
         "user": {
             "id": u.id,
             "username": u.username,
@@ -1219,6 +1885,8 @@ def inject_user_context():
             "profile_image": (u.profile_image or DEFAULT_USER_IMAGE),
         }
     }
+    g._user_ctx = ctx
+    return ctx
 
 
 @app.after_request
@@ -1457,18 +2125,34 @@ def _first(form, *keys, default=""):
             return v.strip()
     return default
 
+# Comparado quando o login não existe: a resposta leva o mesmo tempo de uma senha errada
+_DUMMY_PASSWORD_HASH = _hash_password(secrets.token_hex(16))
+
 def _login_with_credentials(login_input: str, pwd: str) -> tuple[bool, str]:
     if '@' in login_input:
-        user = User.query.filter(func.lower(User.email) == login_input.lower()).first()
+        cond = func.lower(User.email) == login_input.lower()
     else:
-        user = User.query.filter(User.username == login_input).first()
+        cond = User.username == login_input
+    # só as colunas do login (sem hidratar o User inteiro a cada tentativa)
+    row = db.session.execute(select(User.id, User.username, User.password_hash).where(cond).limit(1)).first()
 
-    stored_hash = getattr(user, 'password_hash', None) if user else None
-    if not user or not stored_hash or not check_password_hash(stored_hash, pwd):
+    stored_hash = (row.password_hash if row else None) or _DUMMY_PASSWORD_HASH
+    ok, needs_rehash = _verify_password(stored_hash, pwd)
+    if not ok or not row or not row.password_hash:
         return False, 'Usuario ou senha inválidos.'
 
-    session['user_id'] = user.id
-    session['username'] = user.username
+    if needs_rehash:
+        # migração preguiçosa para argon2 (uma vez por usuário)
+        try:
+            user = db.session.get(User, row.id)
+            user.password_hash = _hash_password(pwd)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print("[AUTH] falha ao regravar hash de senha:", e)
+
+    session['user_id'] = row.id
+    session['username'] = row.username
     return True, ""
 
 @app.route('/api/login', methods=['POST'])
@@ -1577,19 +2261,27 @@ def _build_dashboard_payload(u: User) -> dict[str, Any]:
     # ---------------------------------------
     # Métricas gerais
     # ---------------------------------------
-    total_patients = Patient.query.filter_by(user_id=u.id).count()
-    total_consults = (
-        Consult.query
-        .join(Patient, Patient.id == Consult.patient_id)
-        .filter(Patient.user_id == u.id)
-        .count()
-    )
-
-    pkg, pkg_changed = _ensure_package_usage(u, base_total=DEFAULT_FREE_ANALYSIS_ALLOWANCE)
-    if pkg_changed:
-        db.session.commit()
-    used = _coerce_int(getattr(pkg, "used", 0))
-    total = _coerce_int(getattr(pkg, "total", DEFAULT_FREE_ANALYSIS_ALLOWANCE))
+    # contagens em um único SELECT (subqueries escalares); o pacote já veio junto com o usuário
+    total_patients, total_consults = db.session.execute(
+        select(
+            select(func.count(Patient.id)).where(Patient.user_id == u.id).scalar_subquery(),
+            select(func.count(Consult.id))
+            .join(Patient, Patient.id == Consult.patient_id)
+            .where(Patient.user_id == u.id)
+            .scalar_subquery(),
+        )
+    ).one()
+
+    pkg = u.package_usage
+    used, total = (pkg.used, pkg.total) if pkg else (None, None)
+    # pacote ausente/incompleto: cria ou corrige pelo caminho normal
+    if used is None or total is None or total < DEFAULT_FREE_ANALYSIS_ALLOWANCE:
+        pkg, pkg_changed = _ensure_package_usage(u, base_total=DEFAULT_FREE_ANALYSIS_ALLOWANCE)
+        if pkg_changed:
+            db.session.commit()
+        used, total = pkg.used, pkg.total
+    used = _coerce_int(used)
+    total = _coerce_int(total, default=DEFAULT_FREE_ANALYSIS_ALLOWANCE)
     remaining = max(total - used, 0)
 
     # ---------------------------------------
@@ -1890,7 +2582,7 @@ def admin_extend_subscription(user_id: int):
     else:
         return jsonify({"success": False, "error": "Periodo inválido."}), 400
 
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     if _is_admin_user(user) and user.id != current_user().id:
         return jsonify({"success": False, "error": "Não é possível alterar o admin."}), 400
 
@@ -1910,7 +2602,7 @@ def admin_delete_user(user_id: int):
     if guard:
         return guard
 
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     if _is_admin_user(user):
         return jsonify({"success": False, "error": "Não é possível remover o admin."}), 400
 
@@ -1935,7 +2627,7 @@ def admin_add_credits(user_id: int):
     if amount <= 0:
         return jsonify({"success": False, "error": "Quantidade invalida."}), 400
 
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
 
     try:
         pkg, _changed = _ensure_package_usage(user, base_total=DEFAULT_FREE_ANALYSIS_ALLOWANCE)
@@ -2388,7 +3080,7 @@ def remove_profile_image():
     u = current_user()
 
     # Se a imagem atual for um SecureFile, remove
-    current = (u.profile_image or "").replace("\\", "/")
+    current = u.profile_image or ""
     sid = _extract_securefile_id_from_url(current)
     if sid:
         _delete_securefile_if_owned(sid, u.id)
@@ -2431,13 +3123,9 @@ def update_personal_info():
 
     file = request.files.get("profile_image")
     if file and file.filename:
-        if not allowed_file(file.filename):
-            flash("Tipo de arquivo não permitido. Use png, jpg ou jpeg.", "warning")
-            return redirect(url_for("account"))
-
-        filename = secure_filename(file.filename)
-        ext = filename.rsplit(".", 1)[1].lower()
-        if ext not in {"png", "jpg", "jpeg"}:
+        ext = _image_ext_or_none(file.filename)
+        mime_type = _sniff_image_mime(file) if ext else None
+        if not mime_type:
             flash("Tipo de arquivo não permitido. Use png, jpg ou jpeg.", "warning")
             return redirect(url_for("account"))
 
@@ -2446,19 +3134,27 @@ def update_personal_info():
             flash("Arquivo de imagem inválido.", "warning")
             return redirect(url_for("account"))
 
-        old = (u.profile_image or "").replace("\\", "/")
+        reduced = _downscale_profile_image(content)
+        if reduced:
+            content, ext, mime_type = reduced, "webp", "image/webp"
+
+        old = u.profile_image or ""
         old_sid = _extract_securefile_id_from_url(old)
         if old_sid:
             _delete_securefile_if_owned(old_sid, u.id)
 
         new_name = f"user_{u.id}_{int(_time.time())}.{ext}"
+        digest, rel_path = _store_secure_bytes(content, ext)
+        _make_secure_thumbnail(rel_path)
         sf = SecureFile(
             user_id=u.id,
             kind="profile_image",
             filename=new_name,
-            mime_type=file.mimetype or f"image/{ext}",
+            mime_type=mime_type,
             size_bytes=len(content),
-            data=content,
+            data=_secure_db_copy(rel_path, content),
+            sha256=digest,
+            storage_path=rel_path,
         )
         db.session.add(sf)
         db.session.flush()
@@ -2477,7 +3173,7 @@ def update_password():
     conf = request.form.get("confirm_password", "")
 
     stored_hash = getattr(u, 'password_hash', None) or getattr(u, 'password', None)
-    if not stored_hash or not check_password_hash(stored_hash, cur):
+    if not stored_hash or not _verify_password(stored_hash, cur)[0]:
         flash("Senha atual incorreta.", "warning")
         return redirect(url_for("account"))
 
@@ -2485,7 +3181,7 @@ def update_password():
         flash("As senhas não coincidem.", "warning")
         return redirect(url_for("account"))
 
-    u.password_hash = generate_password_hash(new)
+    u.password_hash = _hash_password(new)
     db.session.commit()
     flash("Senha atualizada com sucesso!", "success")
     return redirect(url_for("account"))
@@ -2723,6 +3419,7 @@ def _process_manual_entry_payload(form, u, analyze_pdf, *, use_ai=False, timings
     if doctor_name:
         _assign_doctor_to_patient(u, p, doctor_name)
     _attach_consult_and_notes(p, dgn, rx)
+    db.session.commit()
 
     clinic_contact = (u.clinic_phone or u.name or u.username or '').strip() or '-'
 
@@ -2834,7 +3531,7 @@ def _process_pdf_upload_payload(
     patient_phone = (request.form.get('patient_phone') or '').strip()
 
     clinic_contact = (u.clinic_phone or u.name or u.username or '').strip() or '-'
-    doctor_display = doctor_name_input or (getattr(u, "name", None) or u.username)
+    doctor_display = doctor_name_input or u.display_name
 
     if use_ai:
         # First, try to identify the patient to get previous exam history
@@ -3650,18 +4347,27 @@ def _format_reference_label(reference_value: Any, gender: Optional[str]) -> str:
     if isinstance(reference_value, list):
         return " / ".join(str(item) for item in reference_value if item)
     return ""
+_BR_DATE_RE = re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4})")
+_ISO_DATE_RE = re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})")
+
 def _parse_birthdate(value: Optional[str]) -> Optional[date]:
+    """dd/mm/aaaa ou aaaa-mm-dd; escolhe o formato pelo regex em vez de tentar strptime."""
     if not value:
         return None
     candidate = value.strip()
-    if not candidate:
+    m = _BR_DATE_RE.fullmatch(candidate)
+    if m:
+        day, month, year = m.groups()
+    else:
+        m = _ISO_DATE_RE.fullmatch(candidate)
+        if not m:
+            return None
+        year, month, day = m.groups()
+    try:
+        return date(int(year), int(month), int(day))
+    except ValueError:
+        # data inexistente (ex.: 31/02)
         return None
-    for fmt in ("%d/%m/%Y", "%Y-%m-%d"):
-        try:
-            return datetime.strptime(candidate, fmt).date()
-        except Exception:
-            continue
-    return None
 
 def _normalize_gender_label(gender: Optional[str]) -> Optional[str]:
     if not gender:
@@ -3760,7 +4466,7 @@ def _get_or_create_patient(u, *, name=None, cpf=None, gender=None, phone=None, b
             profile_image=DEFAULT_PATIENT_IMAGE
         )
         db.session.add(p)
-        db.session.commit()
+        db.session.flush()  # gera p.id; o commit fica a cargo do chamador
         return p
 
     updated = False
@@ -3792,21 +4498,64 @@ def _get_or_create_patient(u, *, name=None, cpf=None, gender=None, phone=None, b
 
     if updated:
         db.session.add(p)
-        db.session.commit()
     return p
 
 # ------------------------------------------------------------------------------
 # Resultados (HTML e PDF)
 # ------------------------------------------------------------------------------
 
+# colunas usadas ao exibir o resultado de uma consulta
+_CONSULT_TEXT_COLUMNS = load_only(Consult.id, Consult.notes, Consult.diagnostic_text, Consult.prescription_text)
+_PRESCRIPTION_SPLIT_KEYS = ("Prescrição:", "Prescricao:", "Prescrição\n", "Prescricao\n")
+
 def _attach_consult_and_notes(p, dgn, rx):
-    """Cria consulta e anexa diagnóstico/prescrição ao paciente."""
+    """Cria consulta e anexa diagnóstico/prescrição ao paciente (sem commit)."""
     notes_blob = (dgn or '') + "\n\nPrescrição:\n" + (rx or '')
     p.notes = (p.notes or '') + "\n\n" + notes_blob if p.notes else notes_blob
-    db.session.add(Consult(patient_id=p.id, date=datetime.today().date(), notes=notes_blob))
-    db.session.commit()
+    db.session.add(Consult(
+        patient_id=p.id,
+        date=datetime.today().date(),
+        notes=notes_blob,
+        diagnostic_text=(dgn or '').strip(),
+        prescription_text=(rx or '').strip(),
+    ))
     return notes_blob
 
+def _consult_texts(consult) -> tuple[str, str]:
+    """(diagnóstico, prescrição) da consulta; consultas antigas sem as colunas caem no split de notes."""
+    if not consult:
+        return "", ""
+    if consult.diagnostic_text is not None or consult.prescription_text is not None:
+        return consult.diagnostic_text or "", consult.prescription_text or ""
+    notes = consult.notes or ""
+    for key in _PRESCRIPTION_SPLIT_KEYS:
+        if key in notes:
+            diagnosis, _, prescription = notes.partition(key)
+            return diagnosis.strip(), prescription.strip()
+    return notes.strip(), ""
+
+def _patient_info_text(patient) -> str:
+    """Bloco "Rótulo: valor" do paciente nos PDFs de resultado (campos vazios são omitidos)."""
+    today = datetime.today().date()
+    birthdate = patient.birthdate
+    age_str = ""
+    if birthdate:
+        try:
+            age = today.year - birthdate.year - ((today.month, today.day) < (birthdate.month, birthdate.day))
+            age_str = f"{age} anos"
+        except Exception:
+            pass
+    phone_str = " / ".join(filter(None, ((patient.phone_primary or "").strip(), (patient.phone_secondary or "").strip())))
+    candidates = (
+        ("Nome:", patient.name or "—"),
+        ("Data de nascimento:", birthdate.strftime("%d/%m/%Y") if birthdate else "—"),
+        ("Idade:", age_str),
+        ("Sexo:", (patient.sex or "").strip()),
+        ("CPF:", (patient.cpf or "").strip()),
+        ("Telefone:", phone_str),
+    )
+    return "\n".join(f"{label} {value}" for label, value in candidates if value)
+
 @app.route('/patient_result/<int:patient_id>')
 @login_required
 def patient_result(patient_id):
@@ -3817,25 +4566,17 @@ def patient_result(patient_id):
 @login_required
 def api_patient_result(patient_id):
     u = current_user()
-    patient = Patient.query.get_or_404(patient_id)
-    if patient.user_id != u.id:
-        abort(403)
+    patient = _owned_or_404(Patient, patient_id, u)
 
     consult = (
         Consult.query
+        .options(_CONSULT_TEXT_COLUMNS)
         .filter_by(patient_id=patient_id)
         .order_by(Consult.date.desc())
         .first()
     )
 
-    notes = consult.notes if consult else ""
-    diagnosis, prescription = "", ""
-    if "Prescrição:" in notes:
-        parts = notes.split("Prescrição:", 1)
-        diagnosis = parts[0].strip()
-        prescription = parts[1].strip()
-    else:
-        diagnosis = notes.strip() if notes else ""
+    diagnosis, prescription = _consult_texts(consult)
 
     patient_payload = {
         "id": patient.id,
@@ -3861,80 +4602,28 @@ def download_pdf(patient_id):
     """
     Gera e faz download do PDF de resultados do paciente (com dados e assinatura).
     """
-    from weasyprint import HTML
     from flask import send_file
     import tempfile
     import re
-    import io
 
     # === Usuário atual ===
     u = current_user()
 
     # Usa o método moderno do SQLAlchemy 2.0
-    patient = db.session.get(Patient, patient_id)
-    if not patient:
-        abort(404)
-
-    if patient.user_id != u.id:
-        abort(403)
+    patient = _owned_or_404(Patient, patient_id, u)
 
     # Última consulta e diagnóstico/prescrição
     consult = (
         db.session.query(Consult)
+        .options(_CONSULT_TEXT_COLUMNS)
         .filter_by(patient_id=patient_id)
         .order_by(Consult.date.desc())
         .first()
     )
 
-    notes = consult.notes if consult else ""
-    diagnosis, prescription = "", ""
-    if notes:
-        split_key = None
-        for key in ["Prescrição:", "Prescricao:", "Prescrição\n", "Prescricao\n"]:
-            if key in notes:
-                split_key = key
-                break
-
-        if split_key:
-            parts = notes.split(split_key, 1)
-            diagnosis = parts[0].strip()
-            prescription = parts[1].strip() if len(parts) > 1 else ""
-        else:
-            diagnosis = notes.strip()
-            prescription = ""
-
-    # === Cálculo da idade ===
-    def _calc_age(birthdate):
-        try:
-            today = datetime.today().date()
-            return today.year - birthdate.year - ((today.month, today.day) < (birthdate.month, birthdate.day))
-        except Exception:
-            return None
+    diagnosis, prescription = _consult_texts(consult)
 
-    age_str = ""
-    if getattr(patient, "birthdate", None):
-        age_val = _calc_age(patient.birthdate)
-        if age_val is not None:
-            age_str = f"{age_val} anos"
-
-    # === Dados básicos do paciente ===
-    sex_str = (patient.sex or "").strip()
-    cpf_str = (patient.cpf or "").strip()
-    phones = [x for x in [(patient.phone_primary or "").strip(), (patient.phone_secondary or "").strip()] if x]
-    phone_str = " / ".join(phones)
-
-    patient_info = [
-        f"Nome: {patient.name or '—'}",
-        f"Data de nascimento: {patient.birthdate.strftime('%d/%m/%Y') if patient.birthdate else '—'}",
-    ]
-    if age_str:
-        patient_info.append(f"Idade: {age_str}")
-    if sex_str:
-        patient_info.append(f"Sexo: {sex_str}")
-    if cpf_str:
-        patient_info.append(f"CPF: {cpf_str}")
-    if phone_str:
-        patient_info.append(f"Telefone: {phone_str}")
+    patient_info = _patient_info_text(patient)
 
     public_base = current_app.config.get("PUBLIC_BASE_URL")
     if public_base:
@@ -3946,35 +4635,25 @@ def download_pdf(patient_id):
         logo_url = os.path.join(current_app.root_path, "static", "images", "2.png")
     html_str = render_template(
         "result_pdf.html",
-        patient_info="\n".join(patient_info),
+        patient_info=patient_info,
         diagnostic_text=diagnosis,
         prescription_text=prescription,
-        doctor_name=(getattr(u, "name", None) or u.username),
+        doctor_name=u.display_name,
         logo_url=logo_url,
     )
 
-    # === Gera PDF ===
-    pdf_io = io.BytesIO()
-    HTML(string=html_str, base_url=current_app.root_path).write_pdf(pdf_io)
-    pdf_io.seek(0)
-
-    # === Salva PDF no banco ===
+    # === Gera PDF direto em arquivo temporário (send_file serve do disco, sem BytesIO) ===
+    fd, pdf_path = tempfile.mkstemp(suffix=".pdf")
+    os.close(fd)
     try:
-        pdf_bytes = pdf_io.getvalue()
-        display_name = f"Resultado_{(patient.name or 'Paciente').replace(' ', '_')}.pdf"
-        consult_id = consult.id if consult else None
-
-        _save_pdf_bytes_to_db(
-            user_id=u.id,
-            patient_id=patient.id,
-            consult_id=consult_id,
-            original_name=display_name,
-            data=pdf_bytes,
-            kind="result_pdf",
+        _weasy_html(html_str).write_pdf(
+            pdf_path,
+            stylesheets=[_weasy_stylesheet("result_pdf.css")],
+            font_config=_weasy_font_config(),
         )
-    except Exception as e:
-        db.session.rollback()
-        print("[PDF] erro ao salvar PDF gerado no DB:", e)
+    except Exception:
+        os.remove(pdf_path)
+        raise
 
     # === Envia PDF ao usuário ===
     download_name = f"Resultado_{(patient.name or 'Paciente').replace(' ', '_')}.pdf"
@@ -3982,14 +4661,25 @@ def download_pdf(patient_id):
     # ✅ Sanitize filename to prevent newline or carriage return issues
     download_name = re.sub(r'[\r\n]+', '', download_name).strip()
 
-    pdf_io.seek(0)
-    return send_file(
-        pdf_io,
+    response = send_file(
+        pdf_path,
         as_attachment=True,
         download_name=download_name,
-        mimetype="application/pdf"
+        mimetype="application/pdf",
+        conditional=True,
     )
 
+    # === Salva PDF no banco (em background; o job apaga o temporário) ===
+    _save_pdf_file_in_background(
+        pdf_path,
+        user_id=u.id,
+        patient_id=patient.id,
+        consult_id=consult.id if consult else None,
+        original_name=f"Resultado_{(patient.name or 'Paciente').replace(' ', '_')}.pdf",
+        kind="result_pdf",
+    )
+    return response
+
 
 @app.route('/lab_analysis/pdf', methods=['POST'])
 @login_required
@@ -4009,7 +4699,7 @@ def lab_analysis_pdf():
     prescription_raw = payload.get("prescription") or []
     orientations_raw = payload.get("orientations") or []
     summary_text = payload.get("summary") or ""
-    doctor_name = payload.get("doctor_name") or (getattr(current_user(), "name", None) or current_user().username)
+    doctor_name = payload.get("doctor_name") or current_user().display_name
 
     patient_override = _parse_json_payload(request.form.get("patient_override"))
     if isinstance(patient_override, dict):
@@ -4040,7 +4730,6 @@ def lab_analysis_pdf():
     if not abnormal:
         abnormal = exams
 
-    from weasyprint import HTML
 
     lines = []
     if patient.get("nome"):
@@ -4065,13 +4754,13 @@ def lab_analysis_pdf():
         logo_url=logo_url,
     )
 
-    pdf_io = io.BytesIO()
-    HTML(string=pdf_html, base_url=current_app.root_path).write_pdf(pdf_io)
-    pdf_io.seek(0)
+    pdf_bytes = _weasy_html(pdf_html).write_pdf(
+        stylesheets=[_weasy_stylesheet("lab_analysis_pdf.css")], font_config=_weasy_font_config()
+    )
 
     filename = f"Analise_{(patient.get('nome') or 'Paciente').replace(' ', '_')}.pdf"
     return send_file(
-        pdf_io,
+        io.BytesIO(pdf_bytes),
         as_attachment=True,
         download_name=filename,
         mimetype="application/pdf",
@@ -4101,7 +4790,7 @@ def api_lab_analysis_view():
     except BadSignature:
         abort(403)
 
-    doctor_name = payload.get("doctor_name") or (getattr(current_user(), "name", None) or current_user().username)
+    doctor_name = payload.get("doctor_name") or current_user().display_name
     analysis = {
         "paciente": payload.get("patient") or {},
         "exames": payload.get("exams") or [],
@@ -4166,9 +4855,15 @@ def public_download():
     if not patient_id:
         abort(403)
 
-    query = PdfFile.query.filter_by(patient_id=patient_id)
+    # um JOIN só: o SecureFile filtrado por kind é o mesmo carregado (com o blob) em pdf.secure_file
+    query = (
+        PdfFile.query
+        .join(PdfFile.secure_file)
+        .options(contains_eager(PdfFile.secure_file).undefer(SecureFile.data))
+        .filter(PdfFile.patient_id == patient_id)
+    )
     if kind:
-        query = query.join(SecureFile).filter(SecureFile.kind == kind)
+        query = query.filter(SecureFile.kind == kind)
     pdf = query.order_by(PdfFile.id.desc()).first()
     if not pdf or not pdf.secure_file:
         abort(404)
@@ -4193,9 +4888,7 @@ def api_patient_exam_history(patient_id: int):
     Returns list of past exams with their resumo_clinico and abnormal values.
     """
     u = current_user()
-    patient = Patient.query.get_or_404(patient_id)
-    if patient.user_id != u.id:
-        abort(403)
+    patient = _owned_or_404(Patient, patient_id, u)
     
     # Get all exam history records ordered by date (most recent first)
     history_records = (
@@ -4219,15 +4912,15 @@ def api_patient_exam_history(patient_id: int):
         
         history_list.append({
             "id": record.id,
-            "exam_date": record.exam_date.isoformat() if record.exam_date else None,
+            "exam_date": record.exam_date,
             "resumo_clinico": record.resumo_clinico or "",
             "abnormal_results": abnormal,
             "total_exams": len(all_results),
             "abnormal_count": len(abnormal),
-            "created_at": record.created_at.isoformat() if record.created_at else None,
+            "created_at": record.created_at,
         })
     
-    return jsonify({
+    return _json_response({
         "success": True,
         "patient_id": patient_id,
         "patient_name": patient.name,
@@ -4243,11 +4936,9 @@ def api_patient_exam_history_detail(patient_id: int, history_id: int):
     Get detailed exam results from a specific history record.
     """
     u = current_user()
-    patient = Patient.query.get_or_404(patient_id)
-    if patient.user_id != u.id:
-        abort(403)
+    patient = _owned_or_404(Patient, patient_id, u)
     
-    record = PatientExamHistory.query.get_or_404(history_id)
+    record = db.get_or_404(PatientExamHistory, history_id)
     if record.patient_id != patient_id or record.user_id != u.id:
         abort(403)
     
@@ -4261,15 +4952,15 @@ def api_patient_exam_history_detail(patient_id: int, history_id: int):
     except (json.JSONDecodeError, TypeError):
         all_results = []
     
-    return jsonify({
+    return _json_response({
         "success": True,
         "id": record.id,
         "patient_id": patient_id,
-        "exam_date": record.exam_date.isoformat() if record.exam_date else None,
+        "exam_date": record.exam_date,
         "resumo_clinico": record.resumo_clinico or "",
         "abnormal_results": abnormal,
         "all_results": all_results,
-        "created_at": record.created_at.isoformat() if record.created_at else None,
+        "created_at": record.created_at,
     })
 
 
@@ -4391,27 +5082,48 @@ def api_agenda_snapshot():
 # Agenda (API)  ✅ corrigida p/ ISO com 'Z' e DELETE
 # ------------------------------------------------------------------------------
 
-def _parse_iso_to_naive_utc(s: str) -> Optional[datetime]:
-    """
-    Converte strings ISO8601 (inclui casos com 'Z' e offsets) para datetime naive em UTC.
-    Retorna None se não conseguir parsear.
-    """
-    s = (s or "").strip()
-    if not s:
-        return None
-    # normaliza 'Z' -> '+00:00'
-    s = s.replace("Z", "+00:00")
-    # normaliza timezone sem ':' no final (ex: +0300 -> +03:00)
-    if re.match(r".*[+-]\d{4}$", s):
-        s = s[:-2] + ":" + s[-2:]
-    try:
-        dt = datetime.fromisoformat(s)
-    except Exception:
-        return None
-    # converte para UTC e remove tzinfo (naive)
-    if dt.tzinfo is not None:
-        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
-    return dt
+if sys.version_info >= (3, 11):
+    # 3.11+: fromisoformat já entende 'Z' e offsets compactos (+0300)
+    def _parse_iso_to_naive_utc(s: str) -> Optional[datetime]:
+        """
+        Converte strings ISO8601 (inclui casos com 'Z' e offsets) para datetime naive em UTC.
+        Retorna None se não conseguir parsear.
+        """
+        s = (s or "").strip()
+        if not s:
+            return None
+        try:
+            dt = datetime.fromisoformat(s)
+        except ValueError:
+            return None
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+        return dt
+else:
+    _TZ_COMPACT_RE = re.compile(r"[+-]\d{4}$")
+
+    def _parse_iso_to_naive_utc(s: str) -> Optional[datetime]:
+        """
+        Converte strings ISO8601 (inclui casos com 'Z' e offsets) para datetime naive em UTC.
+        Retorna None se não conseguir parsear.
+        """
+        s = (s or "").strip()
+        if not s:
+            return None
+        # normaliza 'Z' -> '+00:00'
+        if s.endswith("Z"):
+            s = s[:-1] + "+00:00"
+        # normaliza timezone sem ':' no final (ex: +0300 -> +03:00)
+        elif _TZ_COMPACT_RE.search(s):
+            s = s[:-2] + ":" + s[-2:]
+        try:
+            dt = datetime.fromisoformat(s)
+        except Exception:
+            return None
+        # converte para UTC e remove tzinfo (naive)
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+        return dt
 
 
 def _coerce_to_bool(value: Any) -> bool:
@@ -4449,12 +5161,45 @@ def _jsonify_with_cache(payload, *, max_age: int = 60, stale_while_revalidate: i
     )
 
 
+# Só as colunas que o calendário usa: a listagem lê Rows, sem hidratar AgendaEvent
+_AGENDA_EVENT_COLUMNS = (
+    AgendaEvent.id, AgendaEvent.title, AgendaEvent.start, AgendaEvent.end, AgendaEvent.notes,
+    AgendaEvent.type, AgendaEvent.billing, AgendaEvent.insurer, AgendaEvent.phone, AgendaEvent.send_reminders,
+)
+
+def _serialize_agenda_event(e) -> dict[str, Any]:
+    """Evento no formato do FullCalendar (aceita AgendaEvent ou Row de _AGENDA_EVENT_COLUMNS)."""
+    type_slug = (e.type or "consulta").lower()
+    class_name = f"event-type-{type_slug}"
+    if type_slug == "bloqueio":
+        class_name = "holiday-event " + class_name
+    # extendedProps sem chaves vazias (o front já trata ausência com fallback)
+    extended = {
+        k: v for k, v in (
+            ("notes", e.notes),
+            ("type", e.type),
+            ("billing", e.billing),
+            ("insurer", e.insurer),
+            ("phone", e.phone),
+        ) if v is not None
+    }
+    extended["send_reminders"] = bool(e.send_reminders)
+    return {
+        "id": e.id,
+        "title": e.title or "Evento",
+        "start": e.start,
+        "end":   e.end,
+        "allDay": False,
+        "className": class_name,
+        "extendedProps": extended,
+    }
+
+
 @app.route('/api/events', methods=['GET'])
 @login_required
 def api_events():
     """
     Retorna eventos do usuário. Aceita ?start=...&end=... do FullCalendar.
-    Também inclui Consult (somente leitura), que não possuem id/editable.
     """
     u = current_user()
     start_q = request.args.get('start')  # FC manda algo como 2025-09-01T00:00:00Z
@@ -4463,69 +5208,52 @@ def api_events():
     start_dt = _parse_iso_to_naive_utc(start_q) if start_q else None
     end_dt   = _parse_iso_to_naive_utc(end_q)   if end_q   else None
 
-    q = AgendaEvent.query.filter_by(user_id=u.id)
+    q = select(*_AGENDA_EVENT_COLUMNS).where(AgendaEvent.user_id == u.id)
     if start_dt:
-        q = q.filter(AgendaEvent.end >= start_dt)
+        q = q.where(AgendaEvent.end >= start_dt)
     if end_dt:
-        q = q.filter(AgendaEvent.start <= end_dt)
+        q = q.where(AgendaEvent.start <= end_dt)
 
     types_param = (request.args.get('types') or '').strip()
     if types_param:
         type_values = [t.strip().lower() for t in types_param.split(',') if t.strip()]
         if type_values:
-            q = q.filter(func.lower(AgendaEvent.type).in_(type_values))
+            q = q.where(func.lower(AgendaEvent.type).in_(type_values))
 
     search_term = (request.args.get('search') or '').strip()
     if search_term:
         like_pattern = f"%{search_term}%"
-        q = q.filter(or_(
+        q = q.where(or_(
             AgendaEvent.title.ilike(like_pattern),
             AgendaEvent.notes.ilike(like_pattern),
             AgendaEvent.insurer.ilike(like_pattern),
             AgendaEvent.billing.ilike(like_pattern)
         ))
 
-    events: list[dict[str, Any]] = []
-
     # Eventos da Agenda
-    for e in q.all():
-        type_slug = (getattr(e, "type", "") or "consulta").lower()
-        class_names = []
-        if type_slug == "bloqueio":
-            class_names.append("holiday-event")
-        class_names.append(f"event-type-{type_slug}")
-        events.append({
-            "id": getattr(e, "id", None),
-            "title": e.title or "Evento",
-            "start": e.start.isoformat() if e.start else None,
-            "end":   e.end.isoformat()   if e.end   else None,
-            "allDay": False,
-            "className": " ".join(class_names),
-            "extendedProps": {
-                "notes": getattr(e, "notes", None),
-                "type": getattr(e, "type", None),
-                "billing": getattr(e, "billing", None),
-                "insurer": getattr(e, "insurer", None),
-                "phone": getattr(e, "phone", None),
-                "send_reminders": bool(getattr(e, "send_reminders", False)),
-            },
-        })
-
-    return jsonify(events)
+    events = [_serialize_agenda_event(row) for row in db.session.execute(q)]
+    return Response(orjson.dumps(events), mimetype="application/json")
 
 
 # ------------------------------------------------------------------------------
 # Agenda (API) – cria evento + agenda lembretes WhatsApp
 # ------------------------------------------------------------------------------
-@app.route('/api/add_event', methods=['POST'])
-@login_required
-def api_add_event():
-    """
-    Cria um AgendaEvent e agenda lembretes para médico e paciente.
-    """
-    u = current_user()
-    data = request.get_json(silent=True) or {}
+# O formulário da agenda manda 'YYYY-MM-DD' ou 'YYYY-MM-DDTHH:MM' (datetime-local, sem fuso)
+_AGENDA_DT_RE = re.compile(r"\d{4}-\d{2}-\d{2}(T\d{2}:\d{2})?")
+
+def _parse_agenda_dt(s: str) -> Optional[datetime]:
+    """Formato do formulário via strptime direto; com segundos/'Z'/offset cai no _parse_iso_to_naive_utc."""
+    m = _AGENDA_DT_RE.fullmatch(s)
+    if m is None:
+        return _parse_iso_to_naive_utc(s)
+    try:
+        return datetime.strptime(s, "%Y-%m-%dT%H:%M" if m.group(1) else "%Y-%m-%d")
+    except ValueError:
+        # dia/mês fora do intervalo (ex.: 2026-02-30)
+        return None
 
+def _agenda_event_fields(data: dict) -> tuple[Optional[dict], Optional[str]]:
+    """Valida o payload de um evento e retorna (campos do AgendaEvent, erro)."""
     title   = (data.get('title') or '').strip()
     phone   = (data.get('phone') or '').strip()
     start_s = (data.get('start') or '').strip()
@@ -4540,38 +5268,91 @@ def api_add_event():
         send_reminders = False
 
     if not title or not start_s:
-        return jsonify(success=False, error="Título e data/hora são obrigatórios."), 400
+        return None, "Título e data/hora são obrigatórios."
 
-    start_dt = _parse_iso_to_naive_utc(start_s)
+    start_dt = _parse_agenda_dt(start_s)
     if not start_dt:
-        return jsonify(success=False, error="Formato de data/hora inválido (start)."), 400
+        return None, "Formato de data/hora inválido (start)."
 
-    end_dt = _parse_iso_to_naive_utc(end_s) if end_s else start_dt + timedelta(hours=1)
+    end_dt = _parse_agenda_dt(end_s) if end_s else start_dt + timedelta(hours=1)
     if end_s and not end_dt:
-        return jsonify(success=False, error="Formato de data/hora inválido (end)."), 400
+        return None, "Formato de data/hora inválido (end)."
     if end_dt and end_dt <= start_dt:
         end_dt = end_dt + timedelta(days=1)
 
-    ev = AgendaEvent(
-        user_id=u.id,
-        title=title,
-        phone=phone,
-        start=start_dt,
-        end=end_dt,
-        notes=notes or None,
-        type=type_ or None,
-        billing=billing or None,
-        insurer=insurer or None,
-        send_reminders=send_reminders,
-    )
+    return {
+        "title": title,
+        "phone": phone,
+        "start": start_dt,
+        "end": end_dt,
+        "notes": notes or None,
+        "type": type_ or None,
+        "billing": billing or None,
+        "insurer": insurer or None,
+        "send_reminders": send_reminders,
+    }, None
+
+
+@app.route('/api/add_event', methods=['POST'])
+@login_required
+def api_add_event():
+    """
+    Cria um AgendaEvent e agenda lembretes para médico e paciente.
+    """
+    u = current_user()
+    data = request.get_json(silent=True) or {}
+
+    fields, error = _agenda_event_fields(data)
+    if error:
+        return jsonify(success=False, error=error), 400
+
+    ev = AgendaEvent(user_id=u.id, **fields)
     db.session.add(ev)
     db.session.commit()
 
-    if send_reminders:
+    if ev.send_reminders:
         _schedule_event_reminders(u, ev, include_created=True)
 
     return jsonify(success=True, event_id=ev.id), 201
 
+
+AGENDA_BATCH_MAX = 200
+
+@app.route('/api/events/batch', methods=['POST'])
+@login_required
+def api_add_events_batch():
+    """
+    Cria vários AgendaEvent de uma vez (colar/arrastar no FullCalendar): um INSERT e um commit.
+    Body: {"events": [{...mesmo formato de /api/add_event...}, ...]}
+    """
+    u = current_user()
+    data = request.get_json(silent=True) or {}
+    items = data.get('events')
+    if not isinstance(items, list) or not items:
+        return jsonify(success=False, error="Nenhum evento enviado."), 400
+    if len(items) > AGENDA_BATCH_MAX:
+        return jsonify(success=False, error=f"Máximo de {AGENDA_BATCH_MAX} eventos por requisição."), 400
+
+    mappings = []
+    for idx, item in enumerate(items):
+        fields, error = _agenda_event_fields(item if isinstance(item, dict) else {})
+        if error:
+            return jsonify(success=False, error=f"Evento {idx + 1}: {error}"), 400
+        fields["user_id"] = u.id
+        mappings.append(fields)
+
+    event_ids = db.session.scalars(
+        insert(AgendaEvent).returning(AgendaEvent.id, sort_by_parameter_order=True),
+        mappings,
+    ).all()
+    db.session.commit()
+
+    for event_id, fields in zip(event_ids, mappings):
+        if fields["send_reminders"]:
+            _schedule_event_reminders(u, AgendaEvent(id=event_id, **fields), include_created=True)
+
+    return jsonify(success=True, event_ids=list(event_ids)), 201
+
 scheduler = BackgroundScheduler()
 scheduler.start()
 
@@ -4749,7 +5530,7 @@ def api_event_mutation(event_id: int):
     DELETE: remove o evento.
     """
     u = current_user()
-    ev = AgendaEvent.query.get_or_404(event_id)
+    ev = db.get_or_404(AgendaEvent, event_id)
     if getattr(ev, 'user_id', None) != u.id:
         abort(403)
 
@@ -4818,9 +5599,11 @@ def _normalize_birthdate_input(value: Optional[str]) -> Optional[date]:
         raw = f"{only_digits[:2]}/{only_digits[2:4]}/{only_digits[4:]}"
     return _parse_birthdate(raw)
 
-def _resolve_patient_image(path: Optional[str]) -> str:
+def _resolve_patient_image(path: Optional[str], *, thumb: bool = False) -> str:
     if not path:
         return url_for('static', filename='images/user-icon.png')
+    if thumb and path.startswith('/files/img/'):
+        return '/files/thumb/' + path[len('/files/img/'):]
     if path.startswith(('/static/', '/files/')):
         return path
     if path.startswith('/uploads/'):
@@ -4840,7 +5623,7 @@ def _serialize_patient_summary(patient: Patient) -> dict:
         "phone_primary": patient.phone_primary or "",
         "doctor_name": patient.doctor.name if patient.doctor else "",
         "status": patient.status or "Inativo",
-        "profile_image": _resolve_patient_image(patient.profile_image),
+        "profile_image": _resolve_patient_image(patient.profile_image, thumb=True),
         "exam_count": exam_count,
     }
 
@@ -4882,14 +5665,20 @@ def api_patients():
     u = current_user()
 
     if request.method == 'GET':
-        search = (request.args.get('search') or '').strip().lower()
+        search = (request.args.get('search') or '').strip()
         status = (request.args.get('status') or '').strip()
 
-        patients = Patient.query.filter_by(user_id=u.id).all()
+        # só o nome do médico é usado na listagem; filtros vão no WHERE
+        q = (
+            Patient.query
+            .options(selectinload(Patient.doctor).load_only(Doctor.id, Doctor.name))
+            .filter_by(user_id=u.id)
+        )
         if search:
-            patients = [p for p in patients if search in (p.name or '').lower()]
+            q = q.filter(Patient.name.ilike(f"%{search}%"))
         if status:
-            patients = [p for p in patients if (p.status or '') == status]
+            q = q.filter(Patient.status == status)
+        patients = q.all()
 
         payload = {
             "patients": [_serialize_patient_summary(p) for p in patients],
@@ -4946,13 +5735,10 @@ def api_patients():
     profile_rel = default_image_url
     file = request.files.get('profile_image')
     if file and file.filename:
-        if allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            ext = filename.rsplit('.', 1)[1].lower()
-            dest_dir = os.path.join(STATIC_DIR, "uploads", "patients")
-            os.makedirs(dest_dir, exist_ok=True)
+        ext = _image_ext_or_none(file.filename)
+        if ext and _sniff_image_mime(file):
             new_name = f"patient_{u.id}_{int(time.time())}.{ext}"
-            dest_path = os.path.join(dest_dir, new_name)
+            dest_path = os.path.join(PATIENT_UPLOAD_DIR, new_name)
             file.save(dest_path)
             profile_rel = "/" + os.path.relpath(dest_path, STATIC_DIR).replace("\\", "/")
         else:
@@ -4996,9 +5782,7 @@ def api_patients():
 @login_required
 def api_patient_detail(patient_id: int):
     u = current_user()
-    patient = Patient.query.get_or_404(patient_id)
-    if patient.user_id != u.id:
-        abort(403)
+    patient = _owned_or_404(Patient, patient_id, u)
 
     if request.method == 'GET':
         return jsonify(success=True, patient=_serialize_patient_detail(patient))
@@ -5041,19 +5825,16 @@ def api_patient_detail(patient_id: int):
 
     file = request.files.get('profile_image')
     if file and file.filename:
-        if not allowed_file(file.filename):
-            return jsonify(success=False, error="Tipo de arquivo não permitido."), 400
-
-        filename = secure_filename(file.filename)
-        ext = filename.rsplit('.', 1)[1].lower()
-        if ext not in {"png", "jpg", "jpeg"}:
+        ext = _image_ext_or_none(file.filename)
+        mime_type = _sniff_image_mime(file) if ext else None
+        if not mime_type:
             return jsonify(success=False, error="Tipo de arquivo não permitido."), 400
 
         content = file.read()
         if not content:
             return jsonify(success=False, error="Arquivo de imagem inválido."), 400
 
-        old_rel = (patient.profile_image or "").replace("\\", "/")
+        old_rel = patient.profile_image or ""
         old_sid = _extract_securefile_id_from_url(old_rel)
         if old_sid:
             _delete_securefile_if_owned(old_sid, u.id)
@@ -5061,13 +5842,17 @@ def api_patient_detail(patient_id: int):
             _safe_remove_patient_photo(old_rel)
 
         new_name = f"patient_{u.id}_{int(time.time())}.{ext}"
+        digest, rel_path = _store_secure_bytes(content, ext)
+        _make_secure_thumbnail(rel_path)
         sf = SecureFile(
             user_id=u.id,
             kind="patient_profile_image",
             filename=new_name,
-            mime_type=file.mimetype or f"image/{ext}",
+            mime_type=mime_type,
             size_bytes=len(content),
-            data=content,
+            data=_secure_db_copy(rel_path, content),
+            sha256=digest,
+            storage_path=rel_path,
         )
         db.session.add(sf)
         db.session.flush()
@@ -5138,12 +5923,7 @@ def register_patient():
             else:
                 birthdate_try = birthdate_raw
 
-            for fmt in ("%d/%m/%Y", "%Y-%m-%d"):
-                try:
-                    birthdate = datetime.strptime(birthdate_try, fmt).date()
-                    break
-                except Exception:
-                    continue
+            birthdate = _parse_birthdate(birthdate_try)
 
         sex   = (request.form.get('sex') or '').strip()
         email = (request.form.get('email') or '').strip().lower()
@@ -5197,15 +5977,10 @@ def register_patient():
         profile_rel = default_image_url  # fallback padrão
         file = request.files.get('profile_image')
         if file and file.filename:
-            if allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                ext = filename.rsplit('.', 1)[1].lower()
-
-                dest_dir = os.path.join(STATIC_DIR, "uploads", "patients")
-                os.makedirs(dest_dir, exist_ok=True)
-
+            ext = _image_ext_or_none(file.filename)
+            if ext and _sniff_image_mime(file):
                 new_name = f"patient_{u.id}_{int(_time.time())}.{ext}"
-                dest_path = os.path.join(dest_dir, new_name)
+                dest_path = os.path.join(PATIENT_UPLOAD_DIR, new_name)
                 file.save(dest_path)
 
                 # salva caminho relativo /static/...
@@ -5274,9 +6049,7 @@ def edit_patient(patient_id):
     import time as _time
 
     u = current_user()
-    patient = Patient.query.get_or_404(patient_id)
-    if patient.user_id != u.id:
-        abort(403)
+    patient = _owned_or_404(Patient, patient_id, u)
 
     if request.method == 'GET' and not _request_wants_json():
         return serve_react_index()
@@ -5294,14 +6067,7 @@ def edit_patient(patient_id):
         if birthdate_s and birthdate_s.isdigit() and len(birthdate_s) == 8:
             birthdate_s = f"{birthdate_s[:2]}/{birthdate_s[2:4]}/{birthdate_s[4:]}"
 
-        birthdate = None
-        if birthdate_s:
-            for fmt in ("%d/%m/%Y", "%Y-%m-%d"):
-                try:
-                    birthdate = datetime.strptime(birthdate_s, fmt).date()
-                    break
-                except Exception:
-                    continue
+        birthdate = _parse_birthdate(birthdate_s)
 
         sex       = (request.form.get('sex') or (patient.sex or '')).strip()
         email     = (request.form.get('email') or '').strip().lower()
@@ -5340,23 +6106,20 @@ def edit_patient(patient_id):
         # -----------------------
         file = request.files.get('profile_image')
         if file and file.filename:
-            if not allowed_file(file.filename):
-                flash("Tipo de arquivo não permitido. Use png, jpg ou jpeg.", "warning")
-                return redirect(url_for('edit_patient', patient_id=patient.id))
-
-            filename = secure_filename(file.filename)
-            ext = filename.rsplit('.', 1)[1].lower()
-            if ext not in {"png", "jpg", "jpeg"}:
+            ext = _image_ext_or_none(file.filename)
+            mime_type = _sniff_image_mime(file) if ext else None
+            if not mime_type:
                 flash("Tipo de arquivo não permitido. Use png, jpg ou jpeg.", "warning")
                 return redirect(url_for('edit_patient', patient_id=patient.id))
 
-            content = file.read()
-            if not content:
+            digest, rel_path, size = _store_secure_stream(file.stream, ext)
+            if not size:
                 flash("Arquivo de imagem inválido.", "warning")
                 return redirect(url_for('edit_patient', patient_id=patient.id))
+            _make_secure_thumbnail(rel_path)
 
             # Remove imagem anterior
-            old_rel = (patient.profile_image or "").replace("\\", "/")
+            old_rel = patient.profile_image or ""
             old_sid = _extract_securefile_id_from_url(old_rel)
             if old_sid:
                 _delete_securefile_if_owned(old_sid, u.id)
@@ -5368,9 +6131,11 @@ def edit_patient(patient_id):
                 user_id=u.id,
                 kind="patient_profile_image",
                 filename=new_name,
-                mime_type=file.mimetype or f"image/{ext}",
-                size_bytes=len(content),
-                data=content,
+                mime_type=mime_type,
+                size_bytes=size,
+                data=_secure_db_copy(rel_path),
+                sha256=digest,
+                storage_path=rel_path,
             )
             db.session.add(sf)
             db.session.flush()
@@ -5416,9 +6181,7 @@ def edit_patient(patient_id):
 # Foto do paciente (upload/remover) — compatível com SecureFile
 # ------------------------------------------------------------------------------
 def _patient_photos_dir():
-    dest_dir = os.path.join(STATIC_DIR, "uploads", "patients")
-    os.makedirs(dest_dir, exist_ok=True)
-    return dest_dir
+    return PATIENT_UPLOAD_DIR
 
 def _safe_remove_patient_photo(rel_path: str):
     try:
@@ -5439,32 +6202,27 @@ def patient_update_photo(patient_id: int):
     import time as _time
 
     u = current_user()
-    p = Patient.query.get_or_404(patient_id)
-    if p.user_id != u.id:
-        abort(403)
+    p = _owned_or_404(Patient, patient_id, u)
 
     file = request.files.get("profile_image")
     if not file or not file.filename:
         flash("Selecione um arquivo de imagem.", "warning")
         return redirect(url_for('edit_patient', patient_id=p.id))
 
-    if not allowed_file(file.filename):
+    ext = _image_ext_or_none(file.filename)
+    mime_type = _sniff_image_mime(file) if ext else None
+    if not mime_type:
         flash("Tipo de arquivo não permitido. Use png, jpg ou jpeg.", "warning")
         return redirect(url_for('edit_patient', patient_id=p.id))
 
-    filename = secure_filename(file.filename)
-    ext = filename.rsplit(".", 1)[1].lower()
-    if ext not in {"png", "jpg", "jpeg"}:
-        flash("Tipo de arquivo não permitido. Use png, jpg ou jpeg.", "warning")
-        return redirect(url_for('edit_patient', patient_id=p.id))
-
-    content = file.read()
-    if not content:
+    digest, rel_path, size = _store_secure_stream(file.stream, ext)
+    if not size:
         flash("Arquivo de imagem inválido.", "warning")
         return redirect(url_for('edit_patient', patient_id=p.id))
+    _make_secure_thumbnail(rel_path)
 
     # Remove imagem anterior
-    old_rel = (p.profile_image or "").replace("\\", "/")
+    old_rel = p.profile_image or ""
     old_sid = _extract_securefile_id_from_url(old_rel)
     if old_sid:
         _delete_securefile_if_owned(old_sid, u.id)
@@ -5476,9 +6234,11 @@ def patient_update_photo(patient_id: int):
         user_id=u.id,
         kind="patient_profile_image",
         filename=new_name,
-        mime_type=file.mimetype or f"image/{ext}",
-        size_bytes=len(content),
-        data=content,
+        mime_type=mime_type,
+        size_bytes=size,
+        data=_secure_db_copy(rel_path),
+        sha256=digest,
+        storage_path=rel_path,
     )
     db.session.add(sf)
     db.session.flush()
@@ -5498,12 +6258,10 @@ def patient_remove_photo(patient_id: int):
     Em seguida, volta para a imagem padrão.
     """
     u = current_user()
-    p = Patient.query.get_or_404(patient_id)
-    if p.user_id != u.id:
-        abort(403)
+    p = _owned_or_404(Patient, patient_id, u)
 
     # remove imagem atual (do SecureFile ou física)
-    old_rel = (p.profile_image or "").replace("\\", "/")
+    old_rel = p.profile_image or ""
     old_sid = _extract_securefile_id_from_url(old_rel)
     if old_sid:
         _delete_securefile_if_owned(old_sid, u.id)
@@ -5518,27 +6276,134 @@ def patient_remove_photo(patient_id: int):
     return redirect(url_for('edit_patient', patient_id=p.id))
 
 
+def _blob_slices(file_id: int, start: int, stop: int):
+    """Lê SecureFile.data[start:stop] em fatias de _STREAM_CHUNK via substr() no banco."""
+    pos = start
+    while pos < stop:
+        size = min(_STREAM_CHUNK, stop - pos)
+        chunk = db.session.scalar(
+            select(func.substr(SecureFile.data, pos + 1, size)).where(SecureFile.id == file_id)
+        )
+        if not chunk:
+            break
+        yield bytes(chunk)
+        pos += len(chunk)
+
+def _blob_range_response(sf, etag: str) -> Response:
+    """Resposta (200 ou 206 Partial Content) para um SecureFile guardado como blob."""
+    total = db.session.scalar(select(func.length(SecureFile.data)).where(SecureFile.id == sf.id))
+    if total is None:
+        abort(404)
+
+    start, stop, status = 0, total, 200
+    if request.range is not None:
+        bounds = request.range.range_for_length(total)
+        if bounds is None:
+            resp = Response(status=416)
+            resp.headers["Content-Range"] = f"bytes */{total}"
+            return resp
+        start, stop = bounds
+        status = 206
+
+    resp = Response(
+        stream_with_context(_blob_slices(sf.id, start, stop)),
+        status=status,
+        mimetype=sf.mime_type or "image/jpeg",
+    )
+    resp.content_length = stop - start
+    resp.headers["Accept-Ranges"] = "bytes"
+    if status == 206:
+        resp.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{total}"
+    resp.set_etag(etag)
+    resp.last_modified = sf.created_at
+    resp.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    return resp
+
+
 @app.route('/files/img/<int:file_id>')
 @login_required
 def serve_image(file_id: int):
     """
-    Retorna imagem de perfil armazenada no banco (SecureFile).
+    Retorna imagem de perfil armazenada no SecureFile (disco ou blob no banco).
+    Cada upload gera um id novo, então o conteúdo de um id é imutável: ETag + cache longo,
+    e o 304 sai sem ler o conteúdo.
     """
     u = current_user()
-    sf = SecureFile.query.get_or_404(file_id)
+    sf = db.session.execute(
+        select(
+            SecureFile.id, SecureFile.user_id, SecureFile.mime_type, SecureFile.filename,
+            SecureFile.sha256, SecureFile.storage_path, SecureFile.created_at,
+        ).where(SecureFile.id == file_id)
+    ).first()
+    if not sf:
+        abort(404)
     if sf.user_id is not None and sf.user_id != u.id:
         abort(403)
     if not (sf.mime_type or "").lower().startswith("image/"):
         abort(404)
 
-    bio = BytesIO(sf.data)
-    bio.seek(0)
-    return send_file(
-        bio,
+    etag = sf.sha256 or f"sf-{sf.id}"
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+        return resp
+
+    abs_path = _ensure_secure_file_on_disk(sf)
+    if not abs_path:
+        # blob no banco: lê só o trecho pedido (Range) em fatias, sem carregar tudo na memória
+        return _blob_range_response(sf, etag)
+    if SECURE_ACCEL_PREFIX:
+        return _accel_redirect_response(
+            sf.storage_path, sf.mime_type or "image/jpeg", etag=etag, last_modified=sf.created_at
+        )
+
+    # conteúdo em disco: send_file usa o arquivo direto e responde Range (206) com conditional=True
+    resp = send_file(
+        abs_path,
         as_attachment=False,
         download_name=sf.filename or f"image_{file_id}",
         mimetype=sf.mime_type or "image/jpeg",
+        conditional=True,
+        etag=etag,
+        last_modified=sf.created_at,
     )
+    resp.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    return resp
+
+
+@app.route('/files/thumb/<int:file_id>')
+@login_required
+def serve_image_thumb(file_id: int):
+    """
+    Miniatura 256x256 (WEBP) de uma imagem do SecureFile, para listagens.
+    O conteúdo de um id nunca muda, então pode ficar em cache no navegador.
+    """
+    u = current_user()
+    sf = db.get_or_404(SecureFile, file_id)
+    if sf.user_id is not None and sf.user_id != u.id:
+        abort(403)
+    if not (sf.mime_type or "").lower().startswith("image/"):
+        abort(404)
+
+    abs_path = _ensure_secure_file_on_disk(sf)
+    if not abs_path:
+        # imagem ainda como blob no banco: devolve a original
+        return redirect(url_for('serve_image', file_id=file_id))
+
+    thumb_rel = _make_secure_thumbnail(sf.storage_path)
+    if not thumb_rel:
+        return redirect(url_for('serve_image', file_id=file_id))
+    if SECURE_ACCEL_PREFIX:
+        return _accel_redirect_response(thumb_rel, "image/webp")
+
+    resp = send_file(
+        os.path.join(SECURE_STORAGE_DIR, thumb_rel),
+        mimetype="image/webp",
+        conditional=True,
+    )
+    resp.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    return resp
 
 
 @app.route('/patient_info/<int:patient_id>')
@@ -5587,13 +6452,7 @@ def api_add_patient():
         return jsonify(success=False, error='Campos obrigatórios: nome, data de nascimento, sexo, celular.'), 400
 
     # aceita dd/mm/aaaa e yyyy-mm-dd
-    birthdate = None
-    for fmt in ("%d/%m/%Y", "%Y-%m-%d"):
-        try:
-            birthdate = datetime.strptime(birthdate_s, fmt).date()
-            break
-        except Exception:
-            continue
+    birthdate = _parse_birthdate(birthdate_s)
     if not birthdate:
         return jsonify(success=False, error='Data de nascimento inválida'), 400
 
@@ -5633,13 +6492,26 @@ def delete_patient(patient_id):
     Exclui paciente e suas consultas.
     """
     u = current_user()
-    p = Patient.query.get_or_404(patient_id)
-    if p.user_id != u.id:
-        abort(403)
+    if db.session.scalar(select(Patient.id).where(Patient.id == patient_id, Patient.user_id == u.id)) is None:
+        abort(404)
 
     try:
-        Consult.query.filter_by(patient_id=patient_id).delete(synchronize_session=False)
-        db.session.delete(p)
+        # pdf_files não tem ON DELETE (patient_id/consult_id): sai antes, junto com o blob do SecureFile
+        pdf_filter = or_(
+            PdfFile.patient_id == patient_id,
+            PdfFile.consult_id.in_(select(Consult.id).where(Consult.patient_id == patient_id)),
+        )
+        pdf_blob_ids = db.session.scalars(select(PdfFile.secure_file_id).where(pdf_filter)).all()
+        if pdf_blob_ids:
+            db.session.execute(delete(PdfFile).where(pdf_filter))
+            db.session.execute(delete(SecureFile).where(SecureFile.id.in_(pdf_blob_ids)))
+        # consultas/histórico/pagamentos saem por ON DELETE CASCADE
+        deleted = db.session.execute(
+            delete(Patient).where(Patient.id == patient_id, Patient.user_id == u.id)
+        ).rowcount
+        if deleted and _sqlite_without_fk_cascade():
+            for model in (Consult, PatientExamHistory, PatientPayment):
+                db.session.execute(delete(model).where(model.patient_id == patient_id))
         db.session.commit()
     except Exception as exc:
         db.session.rollback()
@@ -5648,6 +6520,8 @@ def delete_patient(patient_id):
             return jsonify(success=False, message=message), 500
         flash(message, 'warning')
         return redirect(url_for('catalog'))
+    if not deleted:
+        abort(404)
 
     if wants_json_response():
         return jsonify(success=True)
@@ -5663,9 +6537,7 @@ def toggle_patient_status(patient_id, new_status):
     Altera o status (Ativo/Inativo) do paciente.
     """
     u = current_user()
-    p = Patient.query.get_or_404(patient_id)
-    if p.user_id != u.id:
-        abort(403)
+    p = _owned_or_404(Patient, patient_id, u)
 
     p.status = new_status
     try:
@@ -5688,6 +6560,8 @@ def toggle_patient_status(patient_id, new_status):
 # Médicos
 # ------------------------------------------------------------------------------
 
+_DOCTOR_HAS_OWNER = hasattr(Doctor, 'user_id')
+
 def _doctor_scoped_query():
     """
     Retorna somente médicos do usuário logado.
@@ -5695,33 +6569,12 @@ def _doctor_scoped_query():
     """
     u = current_user()
     base = Doctor.query
-    if hasattr(Doctor, 'user_id'):
+    if _DOCTOR_HAS_OWNER:
         base = base.filter(Doctor.user_id == u.id)
     return base
 
 def _doctor_get_or_404_scoped(doctor_id: int):
-    d = Doctor.query.get_or_404(doctor_id)
-    if hasattr(Doctor, 'user_id'):
-        if d.user_id != current_user().id:
-            abort(403)
-    return d
-
-def get_or_create_default_doctor() -> int:
-    name = "(Sem médico)"
-    try:
-        doc = Doctor.query.filter(Doctor.name == name).first()
-    except Exception:
-        try:
-            apply_minimal_migrations()
-        except Exception:
-            pass
-        doc = Doctor.query.filter(Doctor.name == name).first()
-
-    if not doc:
-        doc = Doctor(name=name)
-        db.session.add(doc)
-        db.session.commit()
-    return doc.id
+    return _owned_or_404(Doctor, doctor_id)
 
 @app.route('/doctors')
 @login_required
@@ -5760,6 +6613,13 @@ def doctor_delete(doctor_id):
 # ------------------------------------------------------------------------------
 # Cotações / Fornecedores / Produtos
 # ------------------------------------------------------------------------------
+# '1.234,56' -> '1234.56' numa única passada
+_PRICE_TRANS = str.maketrans({".": "", ",": "."})
+# Teto de preço aceito (R$ 10 bilhões em centavos): acima disso, "Infinity", "1e30" etc. viram "sem preço"
+_PRICE_CENTS_MAX = 10**12
+# Prazo em dias cabe com folga no INTEGER de quote_answers.deadline_days
+_DEADLINE_DAYS_MAX = 100_000
+
 def _format_dt_br(value: Optional[datetime]) -> Optional[str]:
     if not value:
         return None
@@ -5771,6 +6631,17 @@ def _format_dt_br(value: Optional[datetime]) -> Optional[str]:
         except Exception:
             return None
 
+def _parse_id_list(values: Any) -> list[int]:
+    """Ids numéricos únicos (na ordem); entradas inválidas são ignoradas em vez de derrubar a lista."""
+    if not isinstance(values, (list, tuple)):
+        return []
+    ids: dict[int, None] = {}
+    for raw in values:
+        text = str(raw).strip()
+        if text.isdigit():
+            ids[int(text)] = None
+    return list(ids)
+
 def _normalize_quote_items(raw: Any) -> list[str]:
     if isinstance(raw, list):
         return [str(item).strip() for item in raw if str(item).strip()]
@@ -5782,7 +6653,7 @@ def _load_quote_items(raw_text: Optional[str]) -> list[str]:
     if not raw_text:
         return []
     try:
-        parsed = json.loads(raw_text)
+        parsed = orjson.loads(raw_text)
         if isinstance(parsed, list):
             return _normalize_quote_items(parsed)
     except Exception:
@@ -5794,7 +6665,7 @@ def _normalize_quote_answers(raw: Optional[str]) -> list[dict[str, str]]:
     payload: Any = []
     if raw:
         try:
-            payload = json.loads(raw)
+            payload = orjson.loads(raw)
         except Exception:
             payload = []
     if isinstance(payload, dict) and "answers" in payload:
@@ -5808,7 +6679,7 @@ def _normalize_quote_answers(raw: Optional[str]) -> list[dict[str, str]]:
         deadline = item.get("deadline", "")
         if price:
             try:
-                price_val = Decimal(str(price).replace(".", "").replace(",", "."))
+                price_val = Decimal(price.translate(_PRICE_TRANS))
                 price = f"{price_val:.2f}".replace(".", ",")
             except Exception:
                 price = price or ""
@@ -5821,21 +6692,100 @@ def _normalize_quote_answers(raw: Optional[str]) -> list[dict[str, str]]:
         answers.append({"price": price, "deadline": deadline_val})
     return answers
 
+def _price_to_cents(price: Any) -> Optional[int]:
+    """'1.234,56' -> 123456; vazio/inválido -> None."""
+    price_s = str(price or "").strip()
+    if not price_s:
+        return None
+    try:
+        cents = int((Decimal(price_s.translate(_PRICE_TRANS)) * 100).to_integral_value())
+    except (InvalidOperation, ValueError, OverflowError):
+        # OverflowError: "Infinity"/"-Infinity"
+        return None
+    return cents if abs(cents) <= _PRICE_CENTS_MAX else None
+
+def _deadline_to_days(deadline: Any) -> Optional[int]:
+    try:
+        days = int(str(deadline).strip())
+    except (TypeError, ValueError):
+        return None
+    return days if abs(days) <= _DEADLINE_DAYS_MAX else None
+
+def _sync_quote_answers(quote_id: int, supplier_id: int, answers: list[dict[str, Any]]) -> None:
+    """Regrava as linhas de QuoteAnswer do fornecedor (sem commit)."""
+    db.session.query(QuoteAnswer).filter_by(quote_id=quote_id, supplier_id=supplier_id).delete(
+        synchronize_session=False
+    )
+    rows = [
+        {
+            "quote_id": quote_id,
+            "supplier_id": supplier_id,
+            "item_idx": idx,
+            "price_cents": _price_to_cents(ans.get("price")),
+            "deadline_days": _deadline_to_days(ans.get("deadline")),
+        }
+        for idx, ans in enumerate(answers)
+        if isinstance(ans, dict)
+    ]
+    if rows:
+        db.session.execute(insert(QuoteAnswer), rows)
+
+def _best_supplier_per_item_sql(quote_id: int, n_items: int, supplier_ids: list[int]) -> dict[int, int]:
+    """Menor preço por item direto no banco (ROW_NUMBER por item, ordenado por price_cents)."""
+    if not n_items or not supplier_ids:
+        return {}
+    ranked = (
+        select(
+            QuoteAnswer.item_idx,
+            QuoteAnswer.supplier_id,
+            func.row_number().over(
+                partition_by=QuoteAnswer.item_idx,
+                order_by=(QuoteAnswer.price_cents.asc(), QuoteAnswer.supplier_id.asc()),
+            ).label("rn"),
+        )
+        .where(
+            QuoteAnswer.quote_id == quote_id,
+            QuoteAnswer.supplier_id.in_(supplier_ids),
+            QuoteAnswer.price_cents.isnot(None),
+            QuoteAnswer.item_idx < n_items,
+        )
+        .subquery()
+    )
+    rows = db.session.execute(select(ranked.c.item_idx, ranked.c.supplier_id).where(ranked.c.rn == 1)).all()
+    return {int(item_idx): int(sid) for item_idx, sid in rows}
+
 @app.route('/api/quotes', methods=['GET', 'POST'])
 @login_required
 def api_quotes():
     u = current_user()
     if request.method == 'GET':
-        quotes = Quote.query.filter(Quote.user_id == u.id).order_by(Quote.created_at.desc()).all()
-        items = []
-        for q in quotes:
-            items.append({
+        # contagem de respostas agregada no banco + fornecedores em um único IN (sem N+1)
+        # subquery correlacionada: conta só as respostas das cotações deste usuário
+        responses_count = (
+            select(func.count(QuoteResponse.id))
+            .where(QuoteResponse.quote_id == Quote.id)
+            .correlate(Quote)
+            .scalar_subquery()
+        )
+        rows = db.session.execute(
+            select(Quote, responses_count)
+            .options(
+                load_only(Quote.id, Quote.title, Quote.created_at),
+                selectinload(Quote.suppliers).load_only(Supplier.id, Supplier.name),
+            )
+            .where(Quote.user_id == u.id)
+            .order_by(Quote.created_at.desc())
+        ).all()
+        items = [
+            {
                 "id": q.id,
                 "title": q.title,
                 "created_at_br": _format_dt_br(q.created_at),
                 "suppliers": [{"id": s.id, "name": s.name} for s in (q.suppliers or [])],
-                "responses_count": len(q.responses or []),
-            })
+                "responses_count": int(rc or 0),
+            }
+            for q, rc in rows
+        ]
         return jsonify({"quotes": items})
 
     data = request.get_json(silent=True) or {}
@@ -5849,10 +6799,7 @@ def api_quotes():
     if not items_list:
         return jsonify(success=False, error="Informe ao menos um item."), 400
 
-    try:
-        supplier_ids = [int(x) for x in supplier_ids if str(x).strip()]
-    except Exception:
-        supplier_ids = []
+    supplier_ids = _parse_id_list(supplier_ids)
 
     selected_suppliers = []
     if supplier_ids:
@@ -5864,7 +6811,7 @@ def api_quotes():
     q = Quote(
         user_id=u.id,
         title=title,
-        items=json.dumps(items_list, ensure_ascii=False),
+        items=orjson.dumps(items_list).decode(),
     )
     q.suppliers = selected_suppliers  # type: ignore
 
@@ -5896,14 +6843,16 @@ def api_quotes():
 @login_required
 def api_quote_detail(quote_id: int):
     u = current_user()
-    q = Quote.query.get_or_404(quote_id)
-    if q.user_id != u.id:
-        abort(403)
+    q = (
+        Quote.query.options(selectinload(Quote.responses).joinedload(QuoteResponse.supplier))
+        .filter_by(id=quote_id, user_id=u.id)
+        .first_or_404()
+    )
 
     items = _load_quote_items(q.items)
     responses_out = []
     for resp in q.responses or []:
-        supplier = Supplier.query.get(resp.supplier_id) if resp.supplier_id else None
+        supplier = resp.supplier
         supplier_name = supplier.name if supplier else f"Fornecedor #{resp.supplier_id}"
         answers_raw = _normalize_quote_answers(resp.answers)
         answers = []
@@ -5934,9 +6883,12 @@ def api_quote_detail(quote_id: int):
 @login_required
 def api_quote_results(quote_id: int):
     u = current_user()
-    q = Quote.query.get_or_404(quote_id)
-    if q.user_id != u.id:
-        abort(403)
+    # suppliers e responses em SELECTs ... IN únicos (sem lazy load por acesso)
+    q = (
+        Quote.query.options(selectinload(Quote.suppliers), selectinload(Quote.responses))
+        .filter_by(id=quote_id, user_id=u.id)
+        .first_or_404()
+    )
 
     items = _load_quote_items(q.items)
     suppliers = q.suppliers or []
@@ -5950,24 +6902,7 @@ def api_quote_results(quote_id: int):
             continue
         responses_map[sid] = _normalize_quote_answers(resp.answers)
 
-    best_per_item: dict[int, int] = {}
-    for idx in range(len(items)):
-        best_sid = None
-        best_price = None
-        for sid in quote_suppliers_ids:
-            answers = responses_map.get(sid) or []
-            if idx >= len(answers):
-                continue
-            price_s = (answers[idx].get("price") or "").strip()
-            try:
-                price_val = Decimal(price_s.replace(".", "").replace(",", ".")) if price_s else None
-            except Exception:
-                price_val = None
-            if price_val is not None and (best_price is None or price_val < best_price):
-                best_price = price_val
-                best_sid = sid
-        if best_sid is not None:
-            best_per_item[idx] = best_sid
+    best_per_item = _best_supplier_per_item_sql(q.id, len(items), quote_suppliers_ids)
 
     return jsonify({
         "success": True,
@@ -6026,7 +6961,7 @@ def create_quote():
         items_list = [ln.strip() for ln in raw_items.splitlines() if ln.strip()]
 
         # busca instâncias Supplier
-        supplier_ids = [int(x) for x in request.form.getlist('suppliers') if x.strip()]
+        supplier_ids = _parse_id_list(request.form.getlist('suppliers'))
         selected_suppliers = Supplier.query.filter(
             Supplier.user_id == u.id,
             Supplier.id.in_(supplier_ids)
@@ -6035,7 +6970,7 @@ def create_quote():
         q = Quote(
             user_id=u.id,
             title=title,
-            items=json.dumps(items_list, ensure_ascii=False)
+            items=orjson.dumps(items_list).decode()
         )
         q.suppliers = selected_suppliers  # type: ignore
 
@@ -6113,10 +7048,20 @@ def public_quote_response(token: str, *, force_json: bool = False):
             return jsonify({"error": "Link inválido."}), 404
         abort(404)
 
-    quote = Quote.query.get_or_404(quote_id)
-    supplier = Supplier.query.get_or_404(supplier_id)
-
-    if supplier not in (quote.suppliers or []):
+    # dono + empresa no mesmo SELECT (clinic_name/clinic_address abaixo)
+    quote = db.session.get(
+        Quote, quote_id, options=[joinedload(Quote.user).joinedload(User.company)]
+    ) or abort(404)
+    supplier = db.get_or_404(Supplier, supplier_id)
+
+    # vínculo checado direto na tabela de associação, sem carregar todos os fornecedores da cotação
+    linked = db.session.scalar(
+        select(quote_suppliers.c.supplier_id).where(
+            quote_suppliers.c.quote_id == quote.id,
+            quote_suppliers.c.supplier_id == supplier.id,
+        ).limit(1)
+    )
+    if linked is None:
         if wants_json:
             return jsonify({"error": "Acesso negado."}), 403
         abort(403)
@@ -6142,7 +7087,7 @@ def public_quote_response(token: str, *, force_json: bool = False):
         return ("", 410)
 
     try:
-        items_raw = json.loads(quote.items or "[]")
+        items_raw = orjson.loads(quote.items or "[]")
         if isinstance(items_raw, list):
             items = [str(x).strip() for x in items_raw if str(x).strip()]
         else:
@@ -6154,7 +7099,7 @@ def public_quote_response(token: str, *, force_json: bool = False):
     existing_answers: list[dict[str, Any]] = []
     if response_obj and response_obj.answers:
         try:
-            payload = json.loads(response_obj.answers)
+            payload = orjson.loads(response_obj.answers)
             if isinstance(payload, list):
                 existing_answers = payload
         except Exception:
@@ -6203,12 +7148,13 @@ def public_quote_response(token: str, *, force_json: bool = False):
                 response_obj = QuoteResponse(
                     quote_id=quote.id,
                     supplier_id=supplier.id,
-                    answers=json.dumps(answers_payload, ensure_ascii=False),
+                    answers=orjson.dumps(answers_payload).decode(),
                 )
                 db.session.add(response_obj)
             else:
-                response_obj.answers = json.dumps(answers_payload, ensure_ascii=False)
+                response_obj.answers = orjson.dumps(answers_payload).decode()
             response_obj.submitted_at = datetime.utcnow()
+            _sync_quote_answers(quote.id, supplier.id, answers_payload)
             db.session.commit()
             submitted = True
 
@@ -6242,10 +7188,16 @@ def quotes_view(quote_id):
 @login_required
 def quotes_delete(quote_id):
     u = current_user()
-    q = Quote.query.get_or_404(quote_id)
-    if q.user_id != u.id:
+    owner_id = db.session.scalar(select(Quote.user_id).where(Quote.id == quote_id))
+    if owner_id is None:
+        abort(404)
+    if owner_id != u.id:
         abort(403)
-    db.session.delete(q)
+    # um DELETE por tabela (sem carregar respostas/fornecedores para o cascade do ORM)
+    db.session.execute(quote_suppliers.delete().where(quote_suppliers.c.quote_id == quote_id))
+    db.session.execute(delete(QuoteAnswer).where(QuoteAnswer.quote_id == quote_id))
+    db.session.execute(delete(QuoteResponse).where(QuoteResponse.quote_id == quote_id))
+    db.session.execute(delete(Quote).where(Quote.id == quote_id))
     db.session.commit()
     prefers_json = (
         request.headers.get("X-Requested-With") == "XMLHttpRequest"
@@ -6256,6 +7208,102 @@ def quotes_delete(quote_id):
     flash('Cotação removida.', 'info')
     return redirect(url_for('quote_index'))
 
+class _TTLCache:
+    """Cache em memória (por processo) com expiração; thread-safe."""
+
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: dict[Any, tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            hit = self._data.get(key)
+            if not hit:
+                return None
+            expires_at, value = hit
+            if expires_at < time.monotonic():
+                self._data.pop(key, None)
+                return None
+            return value
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            if len(self._data) >= self.maxsize:
+                self._data.clear()
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def pop(self, key) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class _RedisBodyCache:
+    """Mesma interface do _TTLCache, mas compartilhado entre workers (valores bytes no Redis)."""
+
+    def __init__(self, prefix: str, ttl: int):
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, key) -> str:
+        return f"{self.prefix}:{key}"
+
+    def get(self, key):
+        try:
+            return _redis.get(self._key(key))
+        except Exception as e:
+            print(f"[CACHE] falha ao ler {self._key(key)}:", e)
+            return None
+
+    def set(self, key, value: bytes) -> None:
+        try:
+            _redis.setex(self._key(key), self.ttl, value)
+        except Exception as e:
+            print(f"[CACHE] falha ao gravar {self._key(key)}:", e)
+
+    def pop(self, key) -> None:
+        try:
+            _redis.delete(self._key(key))
+        except Exception as e:
+            print(f"[CACHE] falha ao invalidar {self._key(key)}:", e)
+
+
+def _json_body_cache(prefix: str, *, ttl: int, local_ttl: float):
+    """
+    Cache de corpos JSON já serializados. Com Redis a invalidação vale para todos os workers,
+    então o TTL pode ser longo; sem Redis cai no _TTLCache local com TTL curto.
+    """
+    if _redis is not None:
+        return _RedisBodyCache(prefix, ttl)
+    return _TTLCache(ttl=local_ttl)
+
+
+# Lista de fornecedores (dropdown/checkboxes da cotação) já serializada, por usuário.
+_suppliers_json_cache = _json_body_cache("suppliers", ttl=3600, local_ttl=30)
+
+# Lista de produtos sem filtros (GET /api/products), por usuário. Quantidade muda a cada
+# movimentação de estoque, então sem Redis o TTL local é curto.
+_products_json_cache = _json_body_cache("products", ttl=3600, local_ttl=10)
+
+@event.listens_for(Product, "after_insert")
+@event.listens_for(Product, "after_update")
+@event.listens_for(Product, "after_delete")
+def _mark_products_cache_stale(_mapper, _conn, target) -> None:
+    # várias rotas mexem em produto/estoque: invalida no commit em vez de em cada uma delas
+    sess = object_session(target)
+    if sess is not None:
+        sess.info.setdefault("_stale_product_owners", set()).add(target.user_id)
+
+@event.listens_for(Session, "after_commit")
+def _drop_stale_products_cache(sess: Session) -> None:
+    for uid in sess.info.pop("_stale_product_owners", ()):
+        _products_json_cache.pop(uid)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_stale_products_cache(sess: Session) -> None:
+    sess.info.pop("_stale_product_owners", None)
+
 @app.route('/suppliers/add', methods=['POST'], endpoint='add_supplier')
 @login_required
 def add_supplier():
@@ -6271,6 +7319,7 @@ def add_supplier():
     s = Supplier(user_id=u.id, name=name, phone=phone or None, email=email or None)
     db.session.add(s)
     db.session.commit()
+    _suppliers_json_cache.pop(u.id)
 
     flash("Fornecedor cadastrado com sucesso!", "success")
     return redirect(url_for('suppliers'))
@@ -6280,19 +7329,67 @@ def add_supplier():
 def suppliers():
     return serve_react_index()
     
+# ------------------------------------------------------------------------------
+# Paginação por cursor (keyset) das listas
+# ------------------------------------------------------------------------------
+# Sem ?cursor/?limit as APIs devolvem a lista inteira, como as telas de estoque e fornecedores esperam.
+LIST_PAGE_DEFAULT = 50
+LIST_PAGE_MAX = 200
+
+def _keyset_page_args() -> tuple[Optional[str], Optional[int]]:
+    """(cursor, limit) da query string; limit None = lista completa."""
+    cursor = (request.args.get("cursor") or "").strip() or None
+    raw_limit = request.args.get("limit")
+    if cursor is None and raw_limit is None:
+        return None, None
+    return cursor, min(max(_to_int(raw_limit, LIST_PAGE_DEFAULT), 1), LIST_PAGE_MAX)
+
+def _split_cursor(cursor: str) -> Optional[tuple[str, int]]:
+    """Cursor "<chave>|<id>" (o id desempata chaves iguais); None se mal formado."""
+    key, sep, tail = cursor.rpartition("|")
+    if not sep or not tail.isdigit():
+        return None
+    return key, int(tail)
+
+def _load_suppliers_for_user(user_id: int, *, after: Optional[tuple[str, int]] = None, limit: Optional[int] = None):
+    """
+    Fornecedores do usuário por nome, só as colunas da lista (um SELECT, sem hidratar ORM).
+    `after`/`limit` pedem uma página a partir do cursor (name, id), servida pelo ix_suppliers_user_name.
+    """
+    q = (
+        select(Supplier.id, Supplier.name, Supplier.phone, Supplier.email)
+        .where(Supplier.user_id == user_id)
+        .order_by(Supplier.name.asc(), Supplier.id.asc())
+    )
+    if after is not None:
+        q = q.where(tuple_(Supplier.name, Supplier.id) > after)
+    if limit is not None:
+        q = q.limit(limit)
+    return db.session.execute(q).all()
+
 @app.route('/api/suppliers', methods=['GET', 'POST'])
 @login_required
 def api_suppliers():
     u = current_user()
 
     if request.method == 'GET':
-        sups = Supplier.query.filter_by(user_id=u.id).order_by(Supplier.name.asc()).all()
-        return jsonify([{
-            "id": s.id,
-            "name": s.name,
-            "phone": s.phone,
-            "email": s.email
-        } for s in sups])
+        cursor, limit = _keyset_page_args()
+        if limit is not None:
+            after = _split_cursor(cursor) if cursor else None
+            if cursor and after is None:
+                return jsonify(success=False, error="Cursor inválido."), 400
+            rows = _load_suppliers_for_user(u.id, after=after, limit=limit + 1)
+            next_cursor = f"{rows[limit - 1].name}|{rows[limit - 1].id}" if len(rows) > limit else None
+            return _json_response({
+                "suppliers": [row._asdict() for row in rows[:limit]],
+                "next_cursor": next_cursor,
+            })
+
+        body = _suppliers_json_cache.get(u.id)
+        if body is None:
+            body = orjson.dumps([row._asdict() for row in _load_suppliers_for_user(u.id)])
+            _suppliers_json_cache.set(u.id, body)
+        return Response(body, mimetype="application/json")
 
     # POST (criar)
     data = request.get_json(silent=True) or {}
@@ -6305,37 +7402,123 @@ def api_suppliers():
     s = Supplier(user_id=u.id, name=name, phone=phone or None, email=email or None)
     db.session.add(s)
     db.session.commit()
+    _suppliers_json_cache.pop(u.id)
     return jsonify(success=True, id=s.id, name=s.name)
 
+SUPPLIERS_BULK_MAX = 5000
+
+def _copy_suppliers(rows: list[dict[str, Any]]) -> None:
+    """COPY ... FROM STDIN (Postgres) na mesma transação da sessão; executemany nos demais bancos."""
+    conn = db.session.connection()
+    if conn.dialect.name != "postgresql":
+        db.session.execute(insert(Supplier), rows)
+        return
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for r in rows:
+        # campo vazio sem aspas = NULL no COPY CSV
+        writer.writerow((r["user_id"], r["name"], r["phone"] or "", r["email"] or ""))
+    buf.seek(0)
+    with conn.connection.dbapi_connection.cursor() as cur:
+        cur.copy_expert("COPY suppliers (user_id, name, phone, email) FROM STDIN WITH (FORMAT csv)", buf)
+
+@app.route('/api/suppliers/bulk', methods=['POST'])
+@login_required
+def api_suppliers_bulk():
+    """
+    Importa fornecedores em lote: uma transação e um COPY em vez de INSERT+commit por linha.
+    Body: {"suppliers": [{"name": "...", "phone": "...", "email": "..."}, ...]}
+    """
+    u = current_user()
+    data = request.get_json(silent=True) or {}
+    items = data.get('suppliers')
+    if not isinstance(items, list) or not items:
+        return jsonify(success=False, error="Nenhum fornecedor enviado."), 400
+    if len(items) > SUPPLIERS_BULK_MAX:
+        return jsonify(success=False, error=f"Máximo de {SUPPLIERS_BULK_MAX} fornecedores por requisição."), 400
+
+    rows = []
+    for idx, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        name = (item.get('name') or '').strip()
+        if not name:
+            return jsonify(success=False, error=f"Fornecedor {idx + 1}: nome é obrigatório."), 400
+        rows.append({
+            "user_id": u.id,
+            "name": name,
+            "phone": (item.get('phone') or '').strip() or None,
+            "email": (item.get('email') or '').strip() or None,
+        })
+
+    try:
+        _copy_suppliers(rows)
+        db.session.commit()
+    except Exception as exc:
+        db.session.rollback()
+        current_app.logger.error(f"[suppliers] falha na importação em lote: {exc}")
+        return jsonify(success=False, error="Falha ao importar fornecedores."), 500
+    _suppliers_json_cache.pop(u.id)
+    return jsonify(success=True, created=len(rows)), 201
+
 @app.route('/products', methods=['GET'])
 @login_required
 def products():
     return serve_react_index()
 
 
+# Só o que a tabela de produtos mostra (+ created_at do cursor); code/category/application_route/min_stock ficam de fora
+_PRODUCT_LIST_COLUMNS = (
+    Product.id, Product.name, Product.quantity, Product.purchase_price, Product.sale_price, Product.status,
+    Product.created_at,
+)
+
 @app.route('/api/products', methods=['GET', 'POST'])
 @login_required
 def api_products():
     u = current_user()
     if request.method == 'GET':
-        q = Product.query.filter(Product.user_id == u.id)
-
         search = (request.args.get('search') or '').strip()
+        status = (request.args.get('status') or '').strip()
+        cursor, limit = _keyset_page_args()
+        unfiltered = not search and status not in ('Ativo', 'Inativo') and limit is None
+        if unfiltered:
+            body = _products_json_cache.get(u.id)
+            if body is not None:
+                return Response(body, mimetype="application/json")
+
+        # linhas (Row) direto do Core: a lista só lê os valores, não precisa de Product mapeado
+        q = select(*_PRODUCT_LIST_COLUMNS).where(Product.user_id == u.id)
         if search:
             like = f"%{search}%"
-            q = q.filter(
-                or_(
-                    func.lower(Product.name).like(func.lower(like)),
-                    func.lower(func.coalesce(Product.code, '')).like(func.lower(like))
-                )
+            q = q.where(
+                # ILIKE direto na coluna para o índice GIN (pg_trgm) poder atender
+                or_(Product.name.ilike(like), Product.code.ilike(like))
             )
 
-        status = (request.args.get('status') or '').strip()
         if status in ('Ativo', 'Inativo'):
-            q = q.filter(func.trim(Product.status) == status)
+            q = q.where(func.trim(Product.status) == status)
 
-        products = q.order_by(Product.created_at.desc()).all()
-        return jsonify({
+        q = q.order_by(Product.created_at.desc(), Product.id.desc())
+        next_cursor = None
+        if limit is None:
+            products = db.session.execute(q).all()
+        else:
+            if cursor:
+                after = _split_cursor(cursor)
+                try:
+                    after_ts = datetime.fromisoformat(after[0]) if after else None
+                except ValueError:
+                    after_ts = None
+                if after_ts is None:
+                    return jsonify(success=False, error="Cursor inválido."), 400
+                # (created_at, id) < cursor: continua do último item da página anterior
+                q = q.where(tuple_(Product.created_at, Product.id) < (after_ts, after[1]))
+            products = db.session.execute(q.limit(limit + 1)).all()
+            if len(products) > limit:
+                products = products[:limit]
+                next_cursor = f"{products[-1].created_at.isoformat()}|{products[-1].id}"
+
+        body = orjson.dumps({
             "products": [{
                 "id": p.id,
                 "name": p.name,
@@ -6345,7 +7528,11 @@ def api_products():
                 "status": (p.status or 'Inativo').strip() or 'Inativo',
             } for p in products],
             "notifications_unread": 0,
+            **({"next_cursor": next_cursor} if limit is not None else {}),
         })
+        if unfiltered:
+            _products_json_cache.set(u.id, body)
+        return Response(body, mimetype="application/json")
 
     data = request.get_json(silent=True) or {}
     name = (data.get('name') or '').strip()
@@ -6400,9 +7587,7 @@ def _to_int(val, default=0):
 @login_required
 def stock_edit(product_id):
     u = current_user()
-    p = Product.query.get_or_404(product_id)
-    if p.user_id != u.id:
-        abort(403)
+    p = _owned_or_404(Product, product_id, u)
 
     code           = (request.form.get('code') or '').strip()
     name           = (request.form.get('name') or '').strip()
@@ -6442,9 +7627,7 @@ def api_stock_movement():
     if not product_id or not qty:
         return jsonify(success=False, error='Dados inválidos.'), 400
 
-    p = Product.query.get_or_404(product_id)
-    if p.user_id != u.id:
-        abort(403)
+    p = _owned_or_404(Product, product_id, u)
 
     if type_ == 'out':
         qty = -abs(qty)
@@ -6498,9 +7681,7 @@ def stock_movement():
         flash('Dados inválidos para movimentação.', 'warning')
         return redirect(url_for('products'))
 
-    p = Product.query.get_or_404(product_id)
-    if p.user_id != u.id:
-        abort(403)
+    p = _owned_or_404(Product, product_id, u)
 
     if type_ == 'out':
         qty = -abs(qty)
@@ -6597,13 +7778,57 @@ def add_product_route():
 
     return redirect(url_for('products'))
 
+PRODUCTS_BULK_MAX = 5000
+
+@app.route('/api/products/bulk', methods=['POST'])
+@login_required
+def api_products_bulk():
+    """
+    Importa produtos em lote: um INSERT executemany numa transação só, sem flush do ORM por linha.
+    Body: {"products": [{"name": "...", "quantity": 0, "purchase_price": 0, "sale_price": 0, "code": "..."}, ...]}
+    """
+    u = current_user()
+    data = request.get_json(silent=True) or {}
+    items = data.get('products')
+    if not isinstance(items, list) or not items:
+        return jsonify(success=False, error="Nenhum produto enviado."), 400
+    if len(items) > PRODUCTS_BULK_MAX:
+        return jsonify(success=False, error=f"Máximo de {PRODUCTS_BULK_MAX} produtos por requisição."), 400
+
+    now = datetime.utcnow()
+    rows = []
+    for idx, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        name = (item.get('name') or '').strip()
+        if not name:
+            return jsonify(success=False, error=f"Produto {idx + 1}: nome é obrigatório."), 400
+        rows.append({
+            "user_id": u.id,
+            "name": name,
+            "code": (str(item.get('code') or '')).strip() or None,
+            "quantity": max(_to_int(item.get('quantity'), 0), 0),
+            "purchase_price": float(_to_decimal(item.get('purchase_price'))),
+            "sale_price": float(_to_decimal(item.get('sale_price'))),
+            "status": 'Ativo',
+            "created_at": now,
+        })
+
+    try:
+        db.session.execute(insert(Product), rows)
+        db.session.commit()
+    except Exception as exc:
+        db.session.rollback()
+        current_app.logger.error(f"[products] falha na importação em lote: {exc}")
+        return jsonify(success=False, error="Falha ao importar produtos."), 500
+    # INSERT do Core não passa pelos eventos do mapper: invalida a lista aqui
+    _products_json_cache.pop(u.id)
+    return jsonify(success=True, created=len(rows)), 201
+
 @app.route('/delete_product/<int:product_id>', methods=['POST'])
 @login_required
 def delete_product(product_id):
     u = current_user()
-    p = Product.query.get_or_404(product_id)
-    if p.user_id != u.id:
-        abort(403)
+    p = _owned_or_404(Product, product_id, u)
     try:
         db.session.delete(p)
         db.session.commit()
@@ -6625,9 +7850,7 @@ def delete_product(product_id):
 @login_required
 def toggle_product_status(product_id):
     u = current_user()
-    p = Product.query.get_or_404(product_id)
-    if p.user_id != u.id:
-        abort(403)
+    p = _owned_or_404(Product, product_id, u)
 
     # Captura "next" para preservar filtros/pesquisa
     next_url = (
@@ -6673,9 +7896,7 @@ def toggle_product_status(product_id):
 @login_required
 def toggle_product_status_legacy(product_id, new_status):
     u = current_user()
-    p = Product.query.get_or_404(product_id)
-    if p.user_id != u.id:
-        abort(403)
+    p = _owned_or_404(Product, product_id, u)
 
     next_url = request.args.get('next') or request.referrer or url_for('products')
 
@@ -6698,9 +7919,8 @@ def toggle_product_status_legacy(product_id, new_status):
 @login_required
 def update_supplier(supplier_id):
     u = current_user()
-    s = Supplier.query.get_or_404(supplier_id)
-    if getattr(s, 'user_id', None) and s.user_id != u.id:
-        abort(403)
+    # só colunas escalares são usadas: qualquer lazy load acidental vira erro em vez de N+1
+    s = _owned_or_404(Supplier, supplier_id, u, options=(raiseload("*"),))
 
     prefers_json = (
         request.headers.get("X-Requested-With") == "XMLHttpRequest"
@@ -6721,6 +7941,7 @@ def update_supplier(supplier_id):
     s.phone = phone or None
     s.email = email or None
     db.session.commit()
+    _suppliers_json_cache.pop(u.id)
     if prefers_json:
         return jsonify(
             success=True,
@@ -6733,16 +7954,23 @@ def update_supplier(supplier_id):
 @login_required
 def delete_supplier(supplier_id):
     u = current_user()
-    s = Supplier.query.get_or_404(supplier_id)
-    if getattr(s, 'user_id', None) and s.user_id != u.id:
-        abort(403)
+    deleted = db.session.execute(
+        delete(Supplier).where(Supplier.id == supplier_id, Supplier.user_id == u.id)
+    ).rowcount
+    if not deleted:
+        db.session.rollback()
+        abort(404)
+    if _sqlite_without_fk_cascade():
+        db.session.execute(quote_suppliers.delete().where(quote_suppliers.c.supplier_id == supplier_id))
+        for model in (QuoteAnswer, QuoteResponse):
+            db.session.execute(delete(model).where(model.supplier_id == supplier_id))
 
     prefers_json = (
         request.headers.get("X-Requested-With") == "XMLHttpRequest"
         or request.accept_mimetypes.best == "application/json"
     )
-    db.session.delete(s)
     db.session.commit()
+    _suppliers_json_cache.pop(u.id)
     if prefers_json:
         return jsonify(success=True)
     flash('Fornecedor excluído.', 'info')
@@ -6751,46 +7979,73 @@ def delete_supplier(supplier_id):
 # ------------------------------------------------------------------------------
 # Lista de Espera (Waitlist)
 # ------------------------------------------------------------------------------
+WAITLIST_BATCH_MAX = 1000
+
+def _waitlist_fields(data: dict[str, Any]) -> dict[str, Any]:
+    return {
+        'name': (data.get('name') or '').strip(),
+        'billing': (data.get('billing') or 'Particular').strip(),
+        'email': (data.get('email') or '').strip(),
+        'phone1': (data.get('phone1') or '').strip(),
+        'phone2': (data.get('phone2') or '').strip(),
+        'notes': (data.get('notes') or '').strip(),
+    }
+
 @app.route('/api/waitlist', methods=['GET', 'POST'])
 @login_required
 def api_waitlist():
     u = current_user()
 
     if request.method == 'GET':
-        items = (
-            WaitlistItem.query
-            .filter_by(user_id=u.id)
+        # só colunas (sem hidratar objetos ORM nem passar pelo identity map)
+        stmt = (
+            select(
+                WaitlistItem.id, WaitlistItem.name, WaitlistItem.billing, WaitlistItem.email,
+                WaitlistItem.phone1, WaitlistItem.phone2, WaitlistItem.notes, WaitlistItem.created_at,
+            )
+            .where(WaitlistItem.user_id == u.id)
             .order_by(WaitlistItem.created_at.desc())
-            .all()
+            .execution_options(yield_per=500)
         )
-        return jsonify({
-            'items': [{
-                'id': it.id,
-                'name': it.name,
-                'billing': it.billing,
-                'email': it.email,
-                'phone1': it.phone1,
-                'phone2': it.phone2,
-                'notes': it.notes,
-                'created_at': it.created_at.isoformat()
-            } for it in items]
-        })
 
-    # POST (criar)
+        def _generate():
+            # {"items": [...]} linha a linha: memória O(lote), primeiro byte sai antes do fim da query
+            yield b'{"items":['
+            sep = b""
+            for row in db.session.execute(stmt):
+                # orjson serializa datetime em ISO 8601 (mesmo formato de .isoformat())
+                yield sep + orjson.dumps(dict(row._mapping))
+                sep = b","
+            yield b"]}"
+
+        return Response(stream_with_context(_generate()), mimetype="application/json")
+
+    # POST (criar): objeto único ou lista (importação em lote)
     data = request.get_json(silent=True) or {}
-    name = (data.get('name') or '').strip()
-    if not name:
+    if isinstance(data, list):
+        if not data:
+            return jsonify({'success': False, 'error': 'Nenhum item enviado.'}), 400
+        if len(data) > WAITLIST_BATCH_MAX:
+            return jsonify({'success': False, 'error': f'Máximo de {WAITLIST_BATCH_MAX} itens por requisição.'}), 400
+        rows = []
+        for idx, entry in enumerate(data):
+            fields = _waitlist_fields(entry if isinstance(entry, dict) else {})
+            if not fields['name']:
+                return jsonify({'success': False, 'error': f'Item {idx + 1}: nome é obrigatório.'}), 400
+            fields['user_id'] = u.id
+            rows.append(fields)
+        ids = db.session.scalars(
+            insert(WaitlistItem).returning(WaitlistItem.id, sort_by_parameter_order=True),
+            rows,
+        ).all()
+        db.session.commit()
+        return jsonify({'success': True, 'ids': list(ids)}), 201
+
+    fields = _waitlist_fields(data)
+    if not fields['name']:
         return jsonify({'success': False, 'error': 'Nome é obrigatório.'}), 400
 
-    it = WaitlistItem(
-        user_id=u.id,
-        name=name,
-        billing=(data.get('billing') or 'Particular').strip(),
-        email=(data.get('email') or '').strip(),
-        phone1=(data.get('phone1') or '').strip(),
-        phone2=(data.get('phone2') or '').strip(),
-        notes=(data.get('notes') or '').strip(),
-    )
+    it = WaitlistItem(user_id=u.id, **fields)
     db.session.add(it)
     db.session.commit()
     return jsonify({'success': True, 'id': it.id}), 201
@@ -6800,11 +8055,13 @@ def api_waitlist():
 @login_required
 def api_waitlist_delete(item_id: int):
     u = current_user()
-    it = WaitlistItem.query.get_or_404(item_id)
-    if it.user_id != u.id:
+    deleted = db.session.execute(
+        delete(WaitlistItem).where(WaitlistItem.id == item_id, WaitlistItem.user_id == u.id)
+    ).rowcount
+    if not deleted:
+        db.session.rollback()
         return jsonify({'success': False, 'error': 'Item não encontrado.'}), 404
 
-    db.session.delete(it)
     db.session.commit()
     return jsonify({'success': True})
 
@@ -6814,9 +8071,19 @@ def api_waitlist_delete(item_id: int):
 WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN", "").strip()
 WHATSAPP_PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID", "").strip()
 
+# Sessão HTTP compartilhada com prescription.py (pool, retry e Authorization já configurados)
+_WA_SESSION = WHATSAPP_SESSION
+
+# Endpoints do Graph API montados uma vez (o phone number id não muda com o processo no ar)
+_WA_CONFIGURED = bool(WHATSAPP_TOKEN and WHATSAPP_PHONE_NUMBER_ID)
+_WA_MEDIA_URL = f"https://graph.facebook.com/v18.0/{WHATSAPP_PHONE_NUMBER_ID}/media"
+_WA_MSG_URL = f"https://graph.facebook.com/v18.0/{WHATSAPP_PHONE_NUMBER_ID}/messages"
+
+_NON_DIGITS_RE = re.compile(r"\D+")
+
 def normalize_phone(phone: str) -> str:
     """Mantém só dígitos. Se for BR sem +55, tenta prefixar 55."""
-    digits = re.sub(r"\D+", "", phone or "")
+    digits = _NON_DIGITS_RE.sub("", phone or "")
     if not digits:
         return digits
     # Se já vier com 55 no começo, mantém
@@ -6829,17 +8096,15 @@ def normalize_phone(phone: str) -> str:
 
 def whatsapp_upload_media(pdf_bytes: bytes, filename: str) -> Optional[str]:
     """Sobe o PDF para o WhatsApp e retorna media_id."""
-    if not (WHATSAPP_TOKEN and WHATSAPP_PHONE_NUMBER_ID):
+    if not _WA_CONFIGURED:
         print("[WA] Faltando WHATSAPP_TOKEN ou WHATSAPP_PHONE_NUMBER_ID.")
         return None
-    url = f"https://graph.facebook.com/v18.0/{WHATSAPP_PHONE_NUMBER_ID}/media"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
     files = {
         "file": (filename, pdf_bytes, "application/pdf")
     }
     data = {"messaging_product": "whatsapp"}
     try:
-        r = requests.post(url, headers=headers, files=files, data=data, timeout=60)
+        r = _WA_SESSION.post(_WA_MEDIA_URL, files=files, data=data, timeout=60)
         js = r.json() if r.content else {}
         if r.status_code in (200, 201) and js.get("id"):
             return js["id"]
@@ -6850,14 +8115,9 @@ def whatsapp_upload_media(pdf_bytes: bytes, filename: str) -> Optional[str]:
 
 def whatsapp_send_document(phone_number: str, media_id: str, filename: str) -> bool:
     """Envia o documento já upado (media_id) para o número."""
-    if not (WHATSAPP_TOKEN and WHATSAPP_PHONE_NUMBER_ID):
+    if not _WA_CONFIGURED:
         print("[WA] Faltando configurações.")
         return False
-    url = f"https://graph.facebook.com/v18.0/{WHATSAPP_PHONE_NUMBER_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json"
-    }
     payload = {
         "messaging_product": "whatsapp",
         "to": normalize_phone(phone_number),
@@ -6865,7 +8125,7 @@ def whatsapp_send_document(phone_number: str, media_id: str, filename: str) -> b
         "document": {"id": media_id, "filename": filename}
     }
     try:
-        r = requests.post(url, headers=headers, json=payload, timeout=60)
+        r = _WA_SESSION.post(_WA_MSG_URL, json=payload, timeout=60)
         if r.status_code in (200, 201):
             return True
         print("[WA send] status:", r.status_code, "body:", r.text)
@@ -6873,11 +8133,18 @@ def whatsapp_send_document(phone_number: str, media_id: str, filename: str) -> b
         print("[WA send] erro:", e)
     return False
 
+# Upload + envio saem da requisição: a resposta HTTP não espera os round-trips ao Graph API
+_WA_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="wa-send")
+
 def try_send_whatsapp_pdf(phone_number: str, pdf_bytes: bytes, filename: str):
-    """Pipeline completo: sobe o PDF e envia a mensagem. Silencioso em caso de falha."""
+    """Agenda o pipeline (upload + envio) em background. Silencioso em caso de falha."""
     phone = (phone_number or "").strip()
     if not phone:
         return
+    _WA_EXECUTOR.submit(_send_whatsapp_pdf, phone, pdf_bytes, filename)
+
+def _send_whatsapp_pdf(phone: str, pdf_bytes: bytes, filename: str):
+    """Pipeline completo: sobe o PDF e envia a mensagem (roda no _WA_EXECUTOR)."""
     media_id = whatsapp_upload_media(pdf_bytes, filename)
     if media_id:
         ok = whatsapp_send_document(phone, media_id, filename)
@@ -6885,145 +8152,134 @@ def try_send_whatsapp_pdf(phone_number: str, pdf_bytes: bytes, filename: str):
     else:
         print("[WA] não foi possível obter media_id.")
 
-# --- NOVO: helper para gerar o PDF em memória (reuso do /download_pdf) ---
-def generate_result_pdf_bytes(*, patient: Patient, diagnostic_text: str, prescription_text: str, doctor_display_name: str) -> bytes:
+def _rl_draw_lines(c, lines, x: float, y: float, *, leading: float, bottom: Optional[float] = None,
+                   top: Optional[float] = None, font: str = "Times-Roman", size: int = 11) -> float:
     """
-    Gera o PDF (mesma aparência do /download_pdf) e retorna os bytes.
-    Também salva uma cópia no banco (PdfFile/SecureFile) para histórico.
+    Desenha linhas no canvas ReportLab usando um único textObject por página
+    (em vez de um drawString por linha). Quebra de página quando y < bottom.
+    Retorna o y após a última linha.
     """
-    from weasyprint import HTML
-    from flask import current_app
-    u = current_user()
+    t = c.beginText(x, y)
+    t.setFont(font, size)
+    t.setLeading(leading)
+    for ln in lines:
+        t.textLine(ln)
+        y -= leading
+        if bottom is not None and y < bottom:
+            c.drawText(t)
+            c.showPage()
+            y = top
+            t = c.beginText(x, y)
+            t.setFont(font, size)
+            t.setLeading(leading)
+    c.drawText(t)
+    c.setFont(font, size)
+    return y
+
+@lru_cache(maxsize=1)
+def _logo_reader() -> Optional[ImageReader]:
+    """Logo dos PDFs ReportLab decodificado uma vez por processo (None se ausente/ilegível)."""
+    png_path = os.path.join(STATIC_DIR, "images", "logo.png")
+    if not os.path.exists(png_path):
+        return None
+    try:
+        return ImageReader(png_path)
+    except Exception:
+        return None
 
-    # --- Calcula idade ---
-    def _calc_age(birthdate):
+# --- NOVO: helper para gerar o PDF em memória (reuso do /download_pdf) ---
+def _render_result_pdf_reportlab(pdf_io, *, patient_info: str, diagnostic_text: str,
+                                 prescription_text: str, doctor_display: str) -> None:
+    """Desenha o PDF de resultado direto no canvas ReportLab (sem parse/layout de HTML+CSS)."""
+    c = canvas.Canvas(pdf_io, pagesize=A4)
+    width, height = A4
+
+    img = _logo_reader()
+    if img is not None:
         try:
-            today = datetime.today().date()
-            return today.year - birthdate.year - ((today.month, today.day) < (birthdate.month, birthdate.day))
+            target_w = 40 * mm
+            iw, ih = img.getSize()
+            ratio = target_w / iw
+            target_h = ih * ratio
+            c.drawImage(img, width - target_w - 15 * mm, height - target_h - 15 * mm,
+                        width=target_w, height=target_h, preserveAspectRatio=True, mask='auto')
         except Exception:
-            return None
+            pass
 
-    age_str = ""
-    if getattr(patient, "birthdate", None):
-        age_val = _calc_age(patient.birthdate)
-        if age_val is not None:
-            age_str = f"{age_val} anos"
-
-    # --- Informações básicas ---
-    sex_str = (patient.sex or "").strip()
-    cpf_str = (patient.cpf or "").strip()
-    phones = [x for x in [(patient.phone_primary or "").strip(), (patient.phone_secondary or "").strip()] if x]
-    phone_str = " / ".join(phones)
-
-    patient_lines = [
-        f"Nome: {patient.name or '—'}",
-        f"Data de nascimento: {patient.birthdate.strftime('%d/%m/%Y') if patient.birthdate else '—'}",
-    ]
-    if age_str: patient_lines.append(f"Idade: {age_str}")
-    if sex_str: patient_lines.append(f"Sexo: {sex_str}")
-    if cpf_str: patient_lines.append(f"CPF: {cpf_str}")
-    if phone_str: patient_lines.append(f"Telefone: {phone_str}")
-    patient_info = "\n".join(patient_lines)
+    c.setFont("Times-Bold", 16)
+    c.drawCentredString(width / 2, height - 20 * mm, "Resultado da Análise - Ponza Health")
 
-    # --- Gera HTML com o template padrão ---
-    html_str = render_template(
-        "result_pdf.html",
-        patient_info=patient_info,
-        diagnostic_text=(diagnostic_text or "—"),
-        prescription_text=(prescription_text or "—"),
-        doctor_name=doctor_display_name or (getattr(u, "name", None) or u.username),
-    )
+    y = _rl_draw_lines(c, patient_info.splitlines(), 20 * mm, height - 35 * mm, leading=6 * mm)
 
-    pdf_io = BytesIO()
+    y -= 4 * mm
+    c.setFont("Times-Bold", 12)
+    c.drawString(20 * mm, y, "Diagnóstico:")
+    y -= 7 * mm
+    y = _rl_draw_lines(c, (diagnostic_text or "—").splitlines(), 22 * mm, y, leading=6 * mm,
+                       bottom=25 * mm, top=height - 20 * mm)
 
-    # --- 1) Geração via WeasyPrint ---
-    try:
-        HTML(string=html_str, base_url=current_app.root_path).write_pdf(pdf_io)
-        pdf_io.seek(0)
-    except Exception as e:
-        print("[PDF/gen] WeasyPrint error, fallback ReportLab:", e)
-        # --- 2) Fallback ReportLab ---
-        from reportlab.lib.pagesizes import A4
-        from reportlab.pdfgen import canvas
-        from reportlab.lib.units import mm
-        from reportlab.lib.utils import ImageReader
-
-        c = canvas.Canvas(pdf_io, pagesize=A4)
-        width, height = A4
-
-        png_path = os.path.join(STATIC_DIR, "images", "logo.png")
-        if os.path.exists(png_path):
-            try:
-                img = ImageReader(png_path)
-                target_w = 40 * mm
-                iw, ih = img.getSize()
-                ratio = target_w / iw
-                target_h = ih * ratio
-                c.drawImage(img, width - target_w - 15 * mm, height - target_h - 15 * mm,
-                            width=target_w, height=target_h, preserveAspectRatio=True, mask='auto')
-            except Exception:
-                pass
+    y -= 4 * mm
+    c.setFont("Times-Bold", 12)
+    c.drawString(20 * mm, y, "Prescrição:")
+    y -= 7 * mm
+    y = _rl_draw_lines(c, (prescription_text or "—").splitlines(), 22 * mm, y, leading=6 * mm,
+                       bottom=40 * mm, top=height - 20 * mm)
 
-        c.setFont("Times-Bold", 16)
-        c.drawCentredString(width / 2, height - 20 * mm, "Resultado da Análise - Ponza Health")
-
-        c.setFont("Times-Roman", 11)
-        y = height - 35 * mm
-        for ln in patient_info.splitlines():
-            c.drawString(20 * mm, y, ln)
-            y -= 6 * mm
-
-        y -= 4 * mm
-        c.setFont("Times-Bold", 12)
-        c.drawString(20 * mm, y, "Diagnóstico:")
-        y -= 7 * mm
-        c.setFont("Times-Roman", 11)
-        for ln in (diagnostic_text or "—").splitlines():
-            c.drawString(22 * mm, y, ln)
-            y -= 6 * mm
-            if y < 25 * mm:
-                c.showPage()
-                y = height - 20 * mm
-
-        y -= 4 * mm
-        c.setFont("Times-Bold", 12)
-        c.drawString(20 * mm, y, "Prescrição:")
-        y -= 7 * mm
-        c.setFont("Times-Roman", 11)
-        for ln in (prescription_text or "—").splitlines():
-            c.drawString(22 * mm, y, ln)
-            y -= 6 * mm
-            if y < 40 * mm:
-                c.showPage()
-                y = height - 20 * mm
-
-        c.setFont("Times-Roman", 11)
-        c.line(60 * mm, 25 * mm, 150 * mm, 25 * mm)
-        c.drawCentredString(105 * mm, 20 * mm, doctor_display_name or (getattr(u, "name", None) or u.username))
-        c.showPage()
-        c.save()
-        pdf_io.seek(0)
+    c.setFont("Times-Roman", 11)
+    c.line(60 * mm, 25 * mm, 150 * mm, 25 * mm)
+    c.drawCentredString(105 * mm, 20 * mm, doctor_display)
+    c.showPage()
+    c.save()
 
-    # --- Salva cópia no banco ---
-    try:
-        pdf_bytes = pdf_io.getvalue()
-        consult = Consult.query.filter_by(patient_id=patient.id).order_by(Consult.date.desc()).first()
-        consult_id = consult.id if consult else None
-        display_name = f"Resultado_{(patient.name or 'Paciente').replace(' ', '_')}.pdf"
 
-        _save_pdf_bytes_to_db(
-            user_id=u.id,
-            patient_id=patient.id,
-            consult_id=consult_id,
-            original_name=display_name,
-            data=pdf_bytes,
-            kind="result_pdf",
+def generate_result_pdf_bytes(*, patient: Patient, diagnostic_text: str, prescription_text: str, doctor_display_name: str) -> bytes:
+    """
+    Gera o PDF de resultado (ReportLab; WeasyPrint com o template do /download_pdf só como fallback)
+    e retorna os bytes. Também salva uma cópia no banco (PdfFile/SecureFile) para histórico.
+    """
+    u = current_user()
+    doctor_display = doctor_display_name or u.display_name
+
+    patient_info = _patient_info_text(patient)
+
+    # --- 1) ReportLab (página única, milissegundos) ---
+    try:
+        pdf_io = BytesIO()
+        _render_result_pdf_reportlab(
+            pdf_io,
+            patient_info=patient_info,
+            diagnostic_text=diagnostic_text,
+            prescription_text=prescription_text,
+            doctor_display=doctor_display,
         )
+        # uma única cópia dos bytes: usada no banco e no retorno
+        pdf_bytes = pdf_io.getvalue()
+        del pdf_io
     except Exception as e:
-        db.session.rollback()
-        print("[PDF/gen] erro ao salvar cópia do PDF no DB:", e)
+        print("[PDF/gen] ReportLab error, fallback WeasyPrint:", e)
+        # --- 2) Fallback WeasyPrint (mesmo template do /download_pdf) ---
+        html_str = render_template(
+            "result_pdf.html",
+            patient_info=patient_info,
+            diagnostic_text=(diagnostic_text or "—"),
+            prescription_text=(prescription_text or "—"),
+            doctor_name=doctor_display,
+        )
+        pdf_bytes = _weasy_html(html_str).write_pdf(
+            stylesheets=[_weasy_stylesheet("result_pdf.css")], font_config=_weasy_font_config()
+        )
 
-    return pdf_io.getvalue()
+    # --- Salva cópia no banco ---
+    _save_pdf_bytes_in_background(
+        user_id=u.id,
+        patient_id=patient.id,
+        consult_id=_latest_consult_id(patient.id),
+        original_name=f"Resultado_{(patient.name or 'Paciente').replace(' ', '_')}.pdf",
+        data=pdf_bytes,
+        kind="result_pdf",
+    )
+
+    return pdf_bytes
 
 
 def generate_lab_analysis_pdf_bytes(
@@ -7035,7 +8291,6 @@ def generate_lab_analysis_pdf_bytes(
     """
     Gera o PDF do Ponza Lab (com prescrições e observações) e salva no banco.
     """
-    from weasyprint import HTML
     u = current_user()
 
     patient_data = context.get("patient") or {}
@@ -7066,28 +8321,20 @@ def generate_lab_analysis_pdf_bytes(
         logo_url=_resolve_public_logo_url("ponzapdf.png"),
     )
 
-    pdf_io = BytesIO()
-    HTML(string=pdf_html, base_url=current_app.root_path).write_pdf(pdf_io)
-    pdf_io.seek(0)
+    pdf_bytes = _weasy_html(pdf_html).write_pdf(
+        stylesheets=[_weasy_stylesheet("lab_analysis_pdf.css")], font_config=_weasy_font_config()
+    )
 
-    try:
-        pdf_bytes = pdf_io.getvalue()
-        consult = Consult.query.filter_by(patient_id=patient.id).order_by(Consult.date.desc()).first()
-        consult_id = consult.id if consult else None
-        display_name = f"Analise_{(patient.name or 'Paciente').replace(' ', '_')}.pdf"
-        _save_pdf_bytes_to_db(
-            user_id=u.id,
-            patient_id=patient.id,
-            consult_id=consult_id,
-            original_name=display_name,
-            data=pdf_bytes,
-            kind="lab_analysis_pdf",
-        )
-    except Exception as e:
-        db.session.rollback()
-        print("[PDF/gen] erro ao salvar PDF de analise no DB:", e)
+    _save_pdf_bytes_in_background(
+        user_id=u.id,
+        patient_id=patient.id,
+        consult_id=_latest_consult_id(patient.id),
+        original_name=f"Analise_{(patient.name or 'Paciente').replace(' ', '_')}.pdf",
+        data=pdf_bytes,
+        kind="lab_analysis_pdf",
+    )
 
-    return pdf_io.getvalue()
+    return pdf_bytes
 
 
 # ------------------------------------------------------------------------------
@@ -7103,7 +8350,7 @@ def finances_view():
 @login_required
 def api_finances_summary():
     """Get financial summary with statistics."""
-    user = g.user
+    user = current_user()
     now = datetime.utcnow()
     
     # Timeframe filter
@@ -7206,7 +8453,7 @@ def api_finances_summary():
 @login_required
 def api_cashboxes():
     """List or create cashboxes."""
-    user = g.user
+    user = current_user()
     
     if request.method == 'GET':
         status_filter = request.args.get('status', 'all')
@@ -7237,12 +8484,12 @@ def api_cashboxes():
                 'initial_balance': cb.initial_balance,
                 'current_balance': cb.current_balance,
                 'responsible': cb.responsible,
-                'opened_at': cb.opened_at.isoformat() if cb.opened_at else None,
-                'closed_at': cb.closed_at.isoformat() if cb.closed_at else None,
+                'opened_at': cb.opened_at,
+                'closed_at': cb.closed_at,
                 'today_transactions': today_transactions
             })
         
-        return jsonify({'success': True, 'cashboxes': result})
+        return _json_response({'success': True, 'cashboxes': result})
     
     # POST - create new cashbox
     data = request.get_json() or {}
@@ -7278,7 +8525,7 @@ def api_cashboxes():
 @login_required
 def api_cashbox_detail(cashbox_id):
     """Get, update, or delete a specific cashbox."""
-    user = g.user
+    user = current_user()
     cashbox = Cashbox.query.filter(
         Cashbox.id == cashbox_id,
         Cashbox.user_id == user.id
@@ -7293,7 +8540,7 @@ def api_cashbox_detail(cashbox_id):
             CashboxTransaction.cashbox_id == cashbox_id
         ).order_by(CashboxTransaction.created_at.desc()).limit(100).all()
         
-        return jsonify({
+        return _json_response({
             'success': True,
             'cashbox': {
                 'id': cashbox.id,
@@ -7304,8 +8551,8 @@ def api_cashbox_detail(cashbox_id):
                 'initial_balance': cashbox.initial_balance,
                 'current_balance': cashbox.current_balance,
                 'responsible': cashbox.responsible,
-                'opened_at': cashbox.opened_at.isoformat() if cashbox.opened_at else None,
-                'closed_at': cashbox.closed_at.isoformat() if cashbox.closed_at else None
+                'opened_at': cashbox.opened_at,
+                'closed_at': cashbox.closed_at
             },
             'transactions': [{
                 'id': t.id,
@@ -7314,7 +8561,7 @@ def api_cashbox_detail(cashbox_id):
                 'amount': t.amount,
                 'description': t.description,
                 'payment_method': t.payment_method,
-                'created_at': t.created_at.isoformat()
+                'created_at': t.created_at
             } for t in transactions]
         })
     
@@ -7360,7 +8607,7 @@ def api_cashbox_detail(cashbox_id):
 @login_required
 def api_cashbox_add_transaction(cashbox_id):
     """Add a transaction to a cashbox."""
-    user = g.user
+    user = current_user()
     cashbox = Cashbox.query.filter(
         Cashbox.id == cashbox_id,
         Cashbox.user_id == user.id
@@ -7416,7 +8663,7 @@ def api_cashbox_add_transaction(cashbox_id):
 @login_required
 def api_patient_payments():
     """List or create patient payments."""
-    user = g.user
+    user = current_user()
     
     if request.method == 'GET':
         status_filter = request.args.get('status', 'all')
@@ -7448,13 +8695,13 @@ def api_patient_payments():
                 'payment_method': p.payment_method,
                 'payment_type': p.payment_type,
                 'description': p.description,
-                'due_date': p.due_date.isoformat() if p.due_date else None,
-                'paid_at': p.paid_at.isoformat() if p.paid_at else None,
+                'due_date': p.due_date,
+                'paid_at': p.paid_at,
                 'insurance_name': p.insurance_name,
-                'created_at': p.created_at.isoformat()
+                'created_at': p.created_at
             })
         
-        return jsonify({'success': True, 'payments': result})
+        return _json_response({'success': True, 'payments': result})
     
     # POST - create new payment
     data = request.get_json() or {}
@@ -7514,7 +8761,7 @@ def api_patient_payments():
 @login_required
 def api_patient_payment_detail(payment_id):
     """Get, update, or delete a patient payment."""
-    user = g.user
+    user = current_user()
     payment = PatientPayment.query.filter(
         PatientPayment.id == payment_id,
         PatientPayment.user_id == user.id
@@ -7525,7 +8772,7 @@ def api_patient_payment_detail(payment_id):
     
     if request.method == 'GET':
         patient = Patient.query.get(payment.patient_id)
-        return jsonify({
+        return _json_response({
             'success': True,
             'payment': {
                 'id': payment.id,
@@ -7539,11 +8786,11 @@ def api_patient_payment_detail(payment_id):
                 'payment_type': payment.payment_type,
                 'description': payment.description,
                 'notes': payment.notes,
-                'due_date': payment.due_date.isoformat() if payment.due_date else None,
-                'paid_at': payment.paid_at.isoformat() if payment.paid_at else None,
+                'due_date': payment.due_date,
+                'paid_at': payment.paid_at,
                 'insurance_name': payment.insurance_name,
                 'insurance_authorization': payment.insurance_authorization,
-                'created_at': payment.created_at.isoformat()
+                'created_at': payment.created_at
             }
         })
     
@@ -7625,7 +8872,7 @@ def api_patient_payment_detail(payment_id):
 @login_required
 def api_patient_payments_list(patient_id):
     """Get all payments for a specific patient."""
-    user = g.user
+    user = current_user()
     
     patient = Patient.query.filter(
         Patient.id == patient_id,
@@ -7643,7 +8890,7 @@ def api_patient_payments_list(patient_id):
     total_paid = sum(p.amount_paid for p in payments)
     total_pending = sum(p.balance for p in payments if p.status in ['pending', 'partial'])
     
-    return jsonify({
+    return _json_response({
         'success': True,
         'patient': {
             'id': patient.id,
@@ -7663,9 +8910,9 @@ def api_patient_payments_list(patient_id):
             'payment_type': p.payment_type,
             'payment_method': p.payment_method,
             'description': p.description,
-            'due_date': p.due_date.isoformat() if p.due_date else None,
-            'paid_at': p.paid_at.isoformat() if p.paid_at else None,
-            'created_at': p.created_at.isoformat()
+            'due_date': p.due_date,
+            'paid_at': p.paid_at,
+            'created_at': p.created_at
         } for p in payments]
     })
 
@@ -7673,27 +8920,77 @@ def api_patient_payments_list(patient_id):
 # ------------------------------------------------------------------------------
 # Erros / Contexto
 # ------------------------------------------------------------------------------
+class _LazyNow:
+    """`now` dos templates: só chama utcnow() se o template usar ({{ now }}, now.year, now.strftime(...))."""
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        return getattr(datetime.utcnow(), name)
+
+    def __str__(self) -> str:
+        return str(datetime.utcnow())
+
+    def __format__(self, spec: str) -> str:
+        return format(datetime.utcnow(), spec)
+
+_TEMPLATE_GLOBALS = {"now": _LazyNow()}
+
 @app.context_processor
 def inject_globals():
-    return {"now": datetime.utcnow()}
+    return _TEMPLATE_GLOBALS
+
+# Corpos prontos (JSON, texto) por status: enxurrada de 404 de crawler/scan não serializa nada por hit
+_ERROR_BODIES = {
+    403: (orjson.dumps({"error": "forbidden"}), "403 - Proibido".encode()),
+    404: (orjson.dumps({"error": "not_found"}), "404 - Não encontrado".encode()),
+    500: (orjson.dumps({"error": "server_error"}), "500 - Erro interno".encode()),
+}
+
+def _error_response(status: int) -> Response:
+    json_body, text_body = _ERROR_BODIES[status]
+    if _request_wants_json():
+        return Response(json_body, status=status, mimetype="application/json")
+    return Response(text_body, status=status, mimetype="text/html")
 
 @app.errorhandler(403)
 def forbidden(e):
-    if _request_wants_json():
-        return jsonify({"error": "forbidden"}), 403
-    return "403 - Proibido", 403
+    return _error_response(403)
 
 @app.errorhandler(404)
 def not_found(e):
-    if _request_wants_json():
-        return jsonify({"error": "not_found"}), 404
-    return "404 - Não encontrado", 404
+    return _error_response(404)
 
 @app.errorhandler(500)
 def server_error(e):
-    if _request_wants_json():
-        return jsonify({"error": "server_error"}), 500
-    return "500 - Erro interno", 500
+    return _error_response(500)
+
+# Compila os templates Jinja no boot: o primeiro PDF/e-mail não paga o parse
+_PRECOMPILED_TEMPLATES = ("result_pdf.html", "lab_analysis_pdf.html") + tuple(
+    app.jinja_env.list_templates(filter_func=lambda name: name.startswith("emails/") and name.endswith(".html"))
+)
+
+with app.app_context():
+    for _tpl in _PRECOMPILED_TEMPLATES:
+        try:
+            app.jinja_env.get_template(_tpl)
+        except Exception as e:
+            print(f"[TEMPLATES] falha ao pré-compilar {_tpl}: {e}")
+
+def _warm_pdf_stack() -> None:
+    """
+    Importa o WeasyPrint (Pango/cairo, tinycss2, fontTools) e monta fontes + CSS dos PDFs
+    no boot do worker, para o primeiro PDF não pagar centenas de ms de import.
+    """
+    try:
+        import weasyprint  # noqa: F401
+        _weasy_font_config()
+        for css_name in ("result_pdf.css", "lab_analysis_pdf.css"):
+            _weasy_stylesheet(css_name)
+    except Exception as e:
+        print(f"[PDF] WeasyPrint indisponível no boot (fica para o primeiro uso): {e}")
+
+if os.getenv("PDF_WARMUP", "1").strip() != "0":
+    _warm_pdf_stack()
 
 # ------------------------------------------------------------------------------
 # Entrypoint
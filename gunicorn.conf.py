@@ -1,5 +1,27 @@
 """Gunicorn configuration for Render/Python 3.13 compatibility."""
 
+import os
+
 # Render + Python 3.13 can raise "non-blocking sockets are not supported"
 # when Gunicorn tries to use sendfile on non-blocking sockets.
 sendfile = False
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+# Exported so app.py sizes the per-worker DB pool with the same worker count.
+os.environ.setdefault("WEB_CONCURRENCY", "4")
+workers = int(os.environ["WEB_CONCURRENCY"])
+
+# gevent workers: WhatsApp/Graph API calls, DB waits and PDF uploads overlap
+# inside each worker instead of holding a sync worker for seconds.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+
+def post_fork(server, worker):
+    # psycopg2 is a C extension: without a wait callback its queries block the gevent hub.
+    # Runs before the worker imports app.py, so the startup connection is already cooperative.
+    if worker_class == "gevent":
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
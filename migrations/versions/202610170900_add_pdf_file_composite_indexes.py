@@ -0,0 +1,32 @@
+"""add composite indexes on pdf_files and secure_files
+
+Revision ID: 202610170900
+Revises: 202601170900
+Create Date: 2026-10-17 09:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "202610170900"
+down_revision = "202601170900"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Idempotente: só cria se não existir
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    pdf_indexes = {ix["name"] for ix in inspector.get_indexes("pdf_files")}
+    if "ix_pdf_files_patient_secure" not in pdf_indexes:
+        op.create_index("ix_pdf_files_patient_secure", "pdf_files", ["patient_id", "secure_file_id"])
+    sf_indexes = {ix["name"] for ix in inspector.get_indexes("secure_files")}
+    if "ix_secure_files_user_kind" not in sf_indexes:
+        op.create_index("ix_secure_files_user_kind", "secure_files", ["user_id", "kind"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_secure_files_user_kind", table_name="secure_files")
+    op.drop_index("ix_pdf_files_patient_secure", table_name="pdf_files")
@@ -0,0 +1,68 @@
+"""add diagnostic_text/prescription_text to consults
+
+Revision ID: 202610171000
+Revises: 202610170900
+Create Date: 2026-10-17 10:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "202610171000"
+down_revision = "202610170900"
+branch_labels = None
+depends_on = None
+
+_SPLIT_KEYS = ("Prescrição:", "Prescricao:", "Prescrição\n", "Prescricao\n")
+
+
+def _split_notes(notes):
+    for key in _SPLIT_KEYS:
+        if key in notes:
+            diagnosis, _, prescription = notes.partition(key)
+            return diagnosis.strip(), prescription.strip()
+    return notes.strip(), ""
+
+
+def upgrade() -> None:
+    # Idempotente: só cria se não existir
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    cols = {c["name"] for c in inspector.get_columns("consults")}
+    if "diagnostic_text" not in cols:
+        op.add_column("consults", sa.Column("diagnostic_text", sa.Text(), nullable=True))
+    if "prescription_text" not in cols:
+        op.add_column("consults", sa.Column("prescription_text", sa.Text(), nullable=True))
+
+    # Backfill: divide notes uma única vez
+    consults = sa.table(
+        "consults",
+        sa.column("id", sa.Integer),
+        sa.column("notes", sa.Text),
+        sa.column("diagnostic_text", sa.Text),
+        sa.column("prescription_text", sa.Text),
+    )
+    rows = bind.execute(
+        sa.select(consults.c.id, consults.c.notes).where(
+            consults.c.notes.isnot(None),
+            consults.c.diagnostic_text.is_(None),
+            consults.c.prescription_text.is_(None),
+        )
+    ).all()
+    if rows:
+        params = []
+        for row in rows:
+            diagnosis, prescription = _split_notes(row.notes or "")
+            params.append({"cid": row.id, "dgn": diagnosis, "rx": prescription})
+        bind.execute(
+            consults.update()
+            .where(consults.c.id == sa.bindparam("cid"))
+            .values(diagnostic_text=sa.bindparam("dgn"), prescription_text=sa.bindparam("rx")),
+            params,
+        )
+
+
+def downgrade() -> None:
+    op.drop_column("consults", "prescription_text")
+    op.drop_column("consults", "diagnostic_text")
@@ -0,0 +1,32 @@
+"""add (user_id, start, end) on agenda_events and (patient_id, date) on consults
+
+Revision ID: 202610171100
+Revises: 202610171000
+Create Date: 2026-10-17 11:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "202610171100"
+down_revision = "202610171000"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Idempotente: só cria se não existir
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    agenda_indexes = {ix["name"] for ix in inspector.get_indexes("agenda_events")}
+    if "ix_agenda_events_user_range" not in agenda_indexes:
+        op.create_index("ix_agenda_events_user_range", "agenda_events", ["user_id", "start", "end"])
+    consult_indexes = {ix["name"] for ix in inspector.get_indexes("consults")}
+    if "ix_consults_patient_date" not in consult_indexes:
+        op.create_index("ix_consults_patient_date", "consults", ["patient_id", "date"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_consults_patient_date", table_name="consults")
+    op.drop_index("ix_agenda_events_user_range", table_name="agenda_events")
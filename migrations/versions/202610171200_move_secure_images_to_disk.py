@@ -0,0 +1,98 @@
+"""secure_files: sha256 + storage_path for images cached on disk (the DB blob stays)
+
+Revision ID: 202610171200
+Revises: 202610171100
+Create Date: 2026-10-17 12:00:00.000000
+"""
+
+import hashlib
+import os
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "202610171200"
+down_revision = "202610171100"
+branch_labels = None
+depends_on = None
+
+# Mesmo diretório usado pelo app (app.SECURE_STORAGE_DIR)
+_STORAGE_DIR = os.getenv("SECURE_STORAGE_DIR") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "instance", "secure_files"
+)
+_BATCH = 50
+
+secure_files = sa.table(
+    "secure_files",
+    sa.column("id", sa.Integer),
+    sa.column("mime_type", sa.String),
+    sa.column("data", sa.LargeBinary),
+    sa.column("sha256", sa.String),
+    sa.column("storage_path", sa.String),
+)
+
+
+def _ext_for(mime_type):
+    subtype = (mime_type or "").split("/", 1)[-1].lower()
+    return "jpg" if subtype in ("jpeg", "pjpeg") else (subtype or "bin")
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    cols = {c["name"] for c in inspector.get_columns("secure_files")}
+    if "sha256" not in cols:
+        op.add_column("secure_files", sa.Column("sha256", sa.String(length=64), nullable=True))
+        op.create_index("ix_secure_files_sha256", "secure_files", ["sha256"])
+    if "storage_path" not in cols:
+        op.add_column("secure_files", sa.Column("storage_path", sa.String(length=255), nullable=True))
+    with op.batch_alter_table("secure_files") as batch:
+        batch.alter_column("data", existing_type=sa.LargeBinary(), nullable=True)
+
+    # Só preenche sha256/storage_path em lotes (não carrega a tabela inteira). O blob continua no
+    # banco: o disco do container de build/deploy é efêmero, então o arquivo é gravado pelo app na
+    # primeira vez que a imagem é servida (_ensure_secure_file_on_disk).
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select(secure_files.c.id, secure_files.c.mime_type, secure_files.c.data)
+            .where(
+                secure_files.c.id > last_id,
+                secure_files.c.storage_path.is_(None),
+                secure_files.c.data.isnot(None),
+                secure_files.c.mime_type.like("image/%"),
+            )
+            .order_by(secure_files.c.id)
+            .limit(_BATCH)
+        ).all()
+        if not rows:
+            break
+        for row in rows:
+            last_id = row.id
+            digest = hashlib.sha256(row.data).hexdigest()
+            rel_path = f"{digest[:2]}/{digest}.{_ext_for(row.mime_type)}"
+            bind.execute(
+                secure_files.update()
+                .where(secure_files.c.id == row.id)
+                .values(sha256=digest, storage_path=rel_path)
+            )
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    # Linhas gravadas só em disco (SECURE_STORAGE_PERSISTENT=1): traz o conteúdo de volta antes de remover as colunas
+    rows = bind.execute(
+        sa.select(secure_files.c.id, secure_files.c.storage_path)
+        .where(secure_files.c.storage_path.isnot(None), secure_files.c.data.is_(None))
+    ).all()
+    for row in rows:
+        abs_path = os.path.join(_STORAGE_DIR, row.storage_path)
+        if os.path.exists(abs_path):
+            with open(abs_path, "rb") as fh:
+                bind.execute(
+                    secure_files.update().where(secure_files.c.id == row.id).values(data=fh.read())
+                )
+    op.drop_column("secure_files", "storage_path")
+    op.drop_index("ix_secure_files_sha256", table_name="secure_files")
+    op.drop_column("secure_files", "sha256")
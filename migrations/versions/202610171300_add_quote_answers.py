@@ -0,0 +1,109 @@
+"""add quote_answers (normalized per-item prices) and backfill from quote_responses
+
+Revision ID: 202610171300
+Revises: 202610171200
+Create Date: 2026-10-17 13:00:00.000000
+"""
+
+import json
+from decimal import Decimal, InvalidOperation
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "202610171300"
+down_revision = "202610171200"
+branch_labels = None
+depends_on = None
+
+quote_responses = sa.table(
+    "quote_responses",
+    sa.column("quote_id", sa.Integer),
+    sa.column("supplier_id", sa.Integer),
+    sa.column("answer", sa.Text),
+)
+
+
+# Mesmos limites do app (_PRICE_CENTS_MAX / _DEADLINE_DAYS_MAX)
+_PRICE_CENTS_MAX = 10**12
+_DEADLINE_DAYS_MAX = 100_000
+
+
+def _price_to_cents(price):
+    price_s = str(price or "").strip()
+    if not price_s:
+        return None
+    try:
+        cents = int((Decimal(price_s.replace(".", "").replace(",", ".")) * 100).to_integral_value())
+    except (InvalidOperation, ValueError, OverflowError):
+        return None
+    return cents if abs(cents) <= _PRICE_CENTS_MAX else None
+
+
+def _deadline_to_days(deadline):
+    try:
+        days = int(str(deadline).strip())
+    except (TypeError, ValueError):
+        return None
+    return days if abs(days) <= _DEADLINE_DAYS_MAX else None
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if "quote_answers" not in inspector.get_table_names():
+        op.create_table(
+            "quote_answers",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("quote_id", sa.Integer(), sa.ForeignKey("quotes.id", ondelete="CASCADE"), nullable=False),
+            sa.Column("supplier_id", sa.Integer(), sa.ForeignKey("suppliers.id", ondelete="CASCADE"), nullable=False),
+            sa.Column("item_idx", sa.Integer(), nullable=False),
+            sa.Column("price_cents", sa.BigInteger(), nullable=True),
+            sa.Column("deadline_days", sa.Integer(), nullable=True),
+            sa.UniqueConstraint("quote_id", "supplier_id", "item_idx", name="uq_quote_answers_quote_supplier_item"),
+        )
+        op.create_index("ix_quote_answers_supplier_id", "quote_answers", ["supplier_id"])
+        op.create_index(
+            "ix_quote_answers_quote_item_price", "quote_answers", ["quote_id", "item_idx", "price_cents"]
+        )
+
+    # Backfill a partir do JSON já salvo em quote_responses.answer
+    if bind.execute(sa.text("SELECT 1 FROM quote_answers LIMIT 1")).first():
+        return
+    quote_answers = sa.table(
+        "quote_answers",
+        sa.column("quote_id", sa.Integer),
+        sa.column("supplier_id", sa.Integer),
+        sa.column("item_idx", sa.Integer),
+        sa.column("price_cents", sa.BigInteger),
+        sa.column("deadline_days", sa.Integer),
+    )
+    rows = []
+    for resp in bind.execute(
+        sa.select(quote_responses.c.quote_id, quote_responses.c.supplier_id, quote_responses.c.answer)
+    ):
+        try:
+            answers = json.loads(resp.answer or "[]")
+        except ValueError:
+            continue
+        if not isinstance(answers, list):
+            continue
+        for idx, ans in enumerate(answers):
+            if not isinstance(ans, dict):
+                continue
+            rows.append({
+                "quote_id": resp.quote_id,
+                "supplier_id": resp.supplier_id,
+                "item_idx": idx,
+                "price_cents": _price_to_cents(ans.get("price")),
+                "deadline_days": _deadline_to_days(ans.get("deadline")),
+            })
+    if rows:
+        op.bulk_insert(quote_answers, rows)
+
+
+def downgrade() -> None:
+    op.drop_index("ix_quote_answers_quote_item_price", table_name="quote_answers")
+    op.drop_index("ix_quote_answers_supplier_id", table_name="quote_answers")
+    op.drop_table("quote_answers")
@@ -0,0 +1,52 @@
+"""ON DELETE CASCADE for consults.patient_id and quote_responses.supplier_id
+
+Revision ID: 202610171400
+Revises: 202610171300
+Create Date: 2026-10-17 14:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "202610171400"
+down_revision = "202610171300"
+branch_labels = None
+depends_on = None
+
+# (tabela, coluna, tabela referenciada)
+_FKS = (
+    ("consults", "patient_id", "patients"),
+    ("quote_responses", "supplier_id", "suppliers"),
+)
+
+
+def _replace_fk(table, column, referred, ondelete):
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    for fk in inspector.get_foreign_keys(table):
+        if fk["referred_table"] != referred or fk["constrained_columns"] != [column]:
+            continue
+        current = ((fk.get("options") or {}).get("ondelete") or "").upper()
+        if current == (ondelete or ""):
+            return
+        if fk.get("name"):
+            op.drop_constraint(fk["name"], table, type_="foreignkey")
+    op.create_foreign_key(
+        f"{table}_{column}_fkey", table, referred, [column], ["id"], ondelete=ondelete
+    )
+
+
+def upgrade() -> None:
+    # SQLite exigiria recriar a tabela; lá o app apaga os dependentes explicitamente
+    if op.get_bind().dialect.name == "sqlite":
+        return
+    for table, column, referred in _FKS:
+        _replace_fk(table, column, referred, "CASCADE")
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == "sqlite":
+        return
+    for table, column, referred in _FKS:
+        _replace_fk(table, column, referred, None)
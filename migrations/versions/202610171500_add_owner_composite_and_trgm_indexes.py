@@ -0,0 +1,69 @@
+"""composite (user_id, ...) indexes for doctors/products/quotes + pg_trgm name indexes
+
+Revision ID: 202610171500
+Revises: 202610171400
+Create Date: 2026-10-17 15:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "202610171500"
+down_revision = "202610171400"
+branch_labels = None
+depends_on = None
+
+# (nome, tabela, colunas)
+_COMPOSITE = (
+    ("ix_doctors_user_specialty", "doctors", ["user_id", "specialty"]),
+    ("ix_products_user_created", "products", ["user_id", "created_at"]),
+    ("ix_quotes_user_created", "quotes", ["user_id", "created_at"]),
+)
+
+# Índices GIN (pg_trgm) para os filtros ILIKE '%q%' — só Postgres
+_TRGM = (
+    ("ix_doctors_name_trgm", "doctors", "name"),
+    ("ix_products_name_trgm", "products", "name"),
+    ("ix_products_code_trgm", "products", "code"),
+)
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    is_pg = bind.dialect.name == "postgresql"
+    inspector = sa.inspect(bind)
+    existing = {
+        table: {ix["name"] for ix in inspector.get_indexes(table)}
+        for table in ("doctors", "products", "quotes")
+    }
+
+    if not is_pg:
+        for name, table, cols in _COMPOSITE:
+            if name not in existing[table]:
+                op.create_index(name, table, cols)
+        return
+
+    # CONCURRENTLY não roda dentro de transação
+    with op.get_context().autocommit_block():
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for name, table, cols in _COMPOSITE:
+            if name not in existing[table]:
+                op.create_index(name, table, cols, postgresql_concurrently=True)
+        for name, table, col in _TRGM:
+            if name in existing[table]:
+                continue
+            where = f" WHERE {col} IS NOT NULL" if col == "code" else ""
+            op.execute(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} "
+                f"USING gin ({col} gin_trgm_ops){where}"
+            )
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    if bind.dialect.name == "postgresql":
+        for name, _table, _col in _TRGM:
+            op.execute(f"DROP INDEX IF EXISTS {name}")
+    for name, table, _cols in _COMPOSITE:
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,47 @@
+"""patients: (user_id, status) composite index + pg_trgm index on name
+
+Revision ID: 202610171600
+Revises: 202610171500
+Create Date: 2026-10-17 16:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "202610171600"
+down_revision = "202610171500"
+branch_labels = None
+depends_on = None
+
+_COMPOSITE = ("ix_patients_user_status", ["user_id", "status"])
+_TRGM = "ix_patients_name_trgm"
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    existing = {ix["name"] for ix in sa.inspect(bind).get_indexes("patients")}
+    name, cols = _COMPOSITE
+
+    if bind.dialect.name != "postgresql":
+        if name not in existing:
+            op.create_index(name, "patients", cols)
+        return
+
+    # CONCURRENTLY não roda dentro de transação
+    with op.get_context().autocommit_block():
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        if name not in existing:
+            op.create_index(name, "patients", cols, postgresql_concurrently=True)
+        if _TRGM not in existing:
+            op.execute(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {_TRGM} ON patients "
+                "USING gin (name gin_trgm_ops)"
+            )
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    if bind.dialect.name == "postgresql":
+        op.execute(f"DROP INDEX IF EXISTS {_TRGM}")
+    op.drop_index(_COMPOSITE[0], table_name="patients")
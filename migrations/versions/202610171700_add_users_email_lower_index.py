@@ -0,0 +1,36 @@
+"""users: expression index on lower(email) for the signup duplicate check
+
+Revision ID: 202610171700
+Revises: 202610171600
+Create Date: 2026-10-17 17:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "202610171700"
+down_revision = "202610171600"
+branch_labels = None
+depends_on = None
+
+_INDEX = "ix_users_email_lower"
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    existing = {ix["name"] for ix in sa.inspect(bind).get_indexes("users")}
+    if _INDEX in existing:
+        return
+
+    if bind.dialect.name != "postgresql":
+        op.create_index(_INDEX, "users", [sa.text("lower(email)")])
+        return
+
+    # CONCURRENTLY não roda dentro de transação
+    with op.get_context().autocommit_block():
+        op.create_index(_INDEX, "users", [sa.text("lower(email)")], postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    op.drop_index(_INDEX, table_name="users")
@@ -0,0 +1,36 @@
+"""suppliers: (user_id, name) index for the per-user supplier list ordered by name
+
+Revision ID: 202610171800
+Revises: 202610171700
+Create Date: 2026-10-17 18:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "202610171800"
+down_revision = "202610171700"
+branch_labels = None
+depends_on = None
+
+_INDEX = "ix_suppliers_user_name"
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    existing = {ix["name"] for ix in sa.inspect(bind).get_indexes("suppliers")}
+    if _INDEX in existing:
+        return
+
+    if bind.dialect.name != "postgresql":
+        op.create_index(_INDEX, "suppliers", ["user_id", "name"])
+        return
+
+    # CONCURRENTLY não roda dentro de transação
+    with op.get_context().autocommit_block():
+        op.create_index(_INDEX, "suppliers", ["user_id", "name"], postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    op.drop_index(_INDEX, table_name="suppliers")
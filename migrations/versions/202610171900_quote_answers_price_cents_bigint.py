@@ -0,0 +1,35 @@
+"""quote_answers.price_cents: INTEGER -> BIGINT (preços acima de R$ 21 mi estouravam o INSERT)
+
+Revision ID: 202610171900
+Revises: 202610171800
+Create Date: 2026-10-17 19:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "202610171900"
+down_revision = "202610171800"
+branch_labels = None
+depends_on = None
+
+
+def _price_cents_type(bind):
+    for col in sa.inspect(bind).get_columns("quote_answers"):
+        if col["name"] == "price_cents":
+            return col["type"]
+    return None
+
+
+def upgrade() -> None:
+    # Bancos criados pela 202610171300 já corrigida nascem com BIGINT
+    if isinstance(_price_cents_type(op.get_bind()), sa.BigInteger):
+        return
+    with op.batch_alter_table("quote_answers") as batch:
+        batch.alter_column("price_cents", existing_type=sa.Integer(), type_=sa.BigInteger(), existing_nullable=True)
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("quote_answers") as batch:
+        batch.alter_column("price_cents", existing_type=sa.BigInteger(), type_=sa.Integer(), existing_nullable=True)
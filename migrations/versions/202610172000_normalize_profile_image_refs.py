@@ -0,0 +1,35 @@
+"""users/patients: normalize profile_image ('\\' -> '/', trim) for rows written before @validates
+
+Revision ID: 202610172000
+Revises: 202610171900
+Create Date: 2026-10-17 20:00:00.000000
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "202610172000"
+down_revision = "202610171900"
+branch_labels = None
+depends_on = None
+
+_TABLES = ("users", "patients")
+
+
+def upgrade() -> None:
+    # Mesmo resultado do models._normalize_image_ref; as leituras não normalizam mais
+    bind = op.get_bind()
+    for name in _TABLES:
+        table = sa.table(name, sa.column("profile_image", sa.String))
+        normalized = sa.func.trim(sa.func.replace(table.c.profile_image, "\\", "/"))
+        bind.execute(
+            table.update()
+            .where(table.c.profile_image.isnot(None), table.c.profile_image != normalized)
+            .values(profile_image=normalized)
+        )
+
+
+def downgrade() -> None:
+    # Normalização sem volta (o valor original com '\\' não é guardado)
+    pass
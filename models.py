@@ -3,8 +3,8 @@ from datetime import datetime, date, time
 from typing import Optional
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
-from sqlalchemy import UniqueConstraint, Index, ForeignKey
+from sqlalchemy.orm import relationship, deferred, validates
+from sqlalchemy import UniqueConstraint, Index, ForeignKey, func
 
 db = SQLAlchemy()
 
@@ -26,6 +26,13 @@ class BaseModel:
         return f"<{cls}>"
 
 
+def _normalize_image_ref(value: Optional[str]) -> Optional[str]:
+    """URL/caminho de imagem canônico ('/' como separador, sem espaços nas pontas)."""
+    if value is None:
+        return None
+    return value.strip().replace("\\", "/")
+
+
 # ----------------------------
 # Empresas (opcional para multi-tenant)
 # ----------------------------
@@ -73,7 +80,8 @@ class User(db.Model, BaseModel):
     suppliers        = relationship("Supplier", back_populates="user", cascade="all, delete-orphan")
     products         = relationship("Product",  back_populates="user", cascade="all, delete-orphan")
     agenda_events    = relationship("AgendaEvent", back_populates="user", cascade="all, delete-orphan")
-    package_usage    = relationship("PackageUsage", back_populates="user", uselist=False, cascade="all, delete-orphan")
+    # joined: o pacote já vem no mesmo SELECT do usuário logado (dashboard/Ponza Lab)
+    package_usage    = relationship("PackageUsage", back_populates="user", uselist=False, cascade="all, delete-orphan", lazy="joined")
     secure_files     = relationship("SecureFile", back_populates="owner", cascade="all, delete-orphan")
     quotes           = relationship("Quote", back_populates="user")
     scheduled_emails = relationship(
@@ -83,6 +91,20 @@ class User(db.Model, BaseModel):
         passive_deletes=True
     )
 
+    @property
+    def display_name(self) -> str:
+        """Nome exibido em PDFs/assinaturas (name, senão username)."""
+        return self.name or self.username
+
+    @validates("profile_image")
+    def _validate_profile_image(self, _key, value):
+        return _normalize_image_ref(value)
+
+    __table_args__ = (
+        # checagem de e-mail duplicado no cadastro compara lower(email)
+        Index("ix_users_email_lower", func.lower(email)),
+    )
+
 
 class Supplier(db.Model, BaseModel):
     __tablename__ = "suppliers"
@@ -98,6 +120,8 @@ class Supplier(db.Model, BaseModel):
     __table_args__ = (
         Index("ix_suppliers_email", "email"),
         Index("ix_suppliers_phone", "phone"),
+        # lista do usuário já sai ordenada do índice (sem sort)
+        Index("ix_suppliers_user_name", "user_id", "name"),
     )
 
 
@@ -130,6 +154,7 @@ class Product(db.Model, BaseModel):
     __table_args__ = (
         Index("ix_products_status", "status"),
         Index("ix_products_created_at", "created_at"),
+        Index("ix_products_user_created", "user_id", "created_at"),
     )
 
 
@@ -155,6 +180,7 @@ class Doctor(db.Model, BaseModel):
         Index("ix_doctors_crm", "crm"),
         Index("ix_doctors_email", "email"),
         Index("ix_doctors_specialty", "specialty"),
+        Index("ix_doctors_user_specialty", "user_id", "specialty"),
     )
 
 
@@ -201,7 +227,7 @@ class Patient(db.Model, BaseModel):
     status       = db.Column(db.String(20), default="Ativo", nullable=False)
     created_at   = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
-    consults     = relationship("Consult", back_populates="patient", cascade="all, delete-orphan")
+    consults     = relationship("Consult", back_populates="patient", cascade="all, delete-orphan", passive_deletes=True)
 
     __table_args__ = (
         Index("ix_patients_status", "status"),
@@ -210,6 +236,7 @@ class Patient(db.Model, BaseModel):
         Index("ix_patients_cpf", "cpf"),
         Index("ix_patients_email", "email"),
         Index("ix_patients_user_id", "user_id"),
+        Index("ix_patients_user_status", "user_id", "status"),
     )
 
     # -------- Propriedades de compatibilidade com o template --------
@@ -255,15 +282,22 @@ class Patient(db.Model, BaseModel):
         """
         return self.profile_image
 
+    @validates("profile_image")
+    def _validate_profile_image(self, _key, value):
+        # normaliza uma vez na escrita; as leituras usam o valor como está
+        return _normalize_image_ref(value)
+
 
 class Consult(db.Model, BaseModel):
     __tablename__ = "consults"
 
     id         = db.Column(db.Integer, primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey("patients.id"), nullable=False, index=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey("patients.id", ondelete="CASCADE"), nullable=False, index=True)
     doctor_id  = db.Column(db.Integer, db.ForeignKey("doctors.id"), nullable=True, index=True)
 
     notes      = db.Column(db.Text)
+    diagnostic_text   = db.Column(db.Text)
+    prescription_text = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     date       = db.Column(db.Date, nullable=False)
     time       = db.Column(db.Time)
@@ -271,6 +305,10 @@ class Consult(db.Model, BaseModel):
     patient    = relationship("Patient", back_populates="consults")
     doctor     = relationship("Doctor",  back_populates="consults")
 
+    __table_args__ = (
+        Index("ix_consults_patient_date", "patient_id", "date"),
+    )
+
 
 class PackageUsage(db.Model, BaseModel):
     __tablename__ = "package_usage"
@@ -312,6 +350,7 @@ class AgendaEvent(db.Model, BaseModel):
         Index("ix_agenda_events_start", "start"),
         Index("ix_agenda_events_end", "end"),
         Index("ix_agenda_events_type", "type"),
+        Index("ix_agenda_events_user_range", "user_id", "start", "end"),
     )
 
 
@@ -338,6 +377,11 @@ class Quote(db.Model, BaseModel):
 
     user       = db.relationship("User", back_populates="quotes")
     responses  = db.relationship("QuoteResponse", back_populates="quote", cascade="all, delete-orphan")
+    answers    = db.relationship("QuoteAnswer", cascade="all, delete-orphan", passive_deletes=True)
+
+    __table_args__ = (
+        Index("ix_quotes_user_created", "user_id", "created_at"),
+    )
 
 
 class QuoteResponse(db.Model, BaseModel):
@@ -345,7 +389,7 @@ class QuoteResponse(db.Model, BaseModel):
 
     id          = db.Column(db.Integer, primary_key=True)
     quote_id    = db.Column(db.Integer, db.ForeignKey("quotes.id"), nullable=False, index=True)
-    supplier_id = db.Column(db.Integer, db.ForeignKey("suppliers.id"), nullable=False, index=True)
+    supplier_id = db.Column(db.Integer, db.ForeignKey("suppliers.id", ondelete="CASCADE"), nullable=False, index=True)
     answers     = db.Column("answer", db.Text, nullable=False)
     submitted_at= db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
@@ -353,6 +397,23 @@ class QuoteResponse(db.Model, BaseModel):
     supplier    = db.relationship("Supplier")
 
 
+class QuoteAnswer(db.Model, BaseModel):
+    """Resposta normalizada por item (preço em centavos) — usada para achar o melhor preço no SQL."""
+    __tablename__ = "quote_answers"
+
+    id            = db.Column(db.Integer, primary_key=True)
+    quote_id      = db.Column(db.Integer, db.ForeignKey("quotes.id", ondelete="CASCADE"), nullable=False)
+    supplier_id   = db.Column(db.Integer, db.ForeignKey("suppliers.id", ondelete="CASCADE"), nullable=False, index=True)
+    item_idx      = db.Column(db.Integer, nullable=False)
+    price_cents   = db.Column(db.BigInteger, nullable=True)
+    deadline_days = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("quote_id", "supplier_id", "item_idx", name="uq_quote_answers_quote_supplier_item"),
+        Index("ix_quote_answers_quote_item_price", "quote_id", "item_idx", "price_cents"),
+    )
+
+
 class Reference(db.Model, BaseModel):
     __tablename__ = "references"
 
@@ -381,11 +442,18 @@ class SecureFile(db.Model, BaseModel):
     filename      = db.Column(db.String(255), nullable=False)
     mime_type     = db.Column(db.String(100), nullable=False)
     size_bytes    = db.Column(db.Integer,     nullable=False)
-    data          = db.Column(db.LargeBinary, nullable=False)
+    # deferred: o blob só é lido quando acessado (undefer() onde o conteúdo é enviado)
+    data          = deferred(db.Column(db.LargeBinary, nullable=True))  # NULL só com SECURE_STORAGE_PERSISTENT=1
+    sha256        = db.Column(db.String(64),  nullable=True, index=True)
+    storage_path  = db.Column(db.String(255), nullable=True)  # relativo a SECURE_STORAGE_DIR
     created_at    = db.Column(db.DateTime,    default=datetime.utcnow, nullable=False)
 
     owner = relationship("User", back_populates="secure_files", foreign_keys=[user_id])
 
+    __table_args__ = (
+        Index("ix_secure_files_user_kind", "user_id", "kind"),
+    )
+
 
 class PdfFile(db.Model, BaseModel):
     __tablename__ = "pdf_files"
@@ -402,6 +470,10 @@ class PdfFile(db.Model, BaseModel):
     patient_id     = db.Column(db.Integer, db.ForeignKey("patients.id"), index=True, nullable=True)
     consult_id     = db.Column(db.Integer, db.ForeignKey("consults.id"),  index=True, nullable=True)
 
+    __table_args__ = (
+        Index("ix_pdf_files_patient_secure", "patient_id", "secure_file_id"),
+    )
+
 
 class WaitlistItem(db.Model, BaseModel):
     __tablename__ = "waitlist_items"
@@ -3,6 +3,8 @@ import re
 import json
 import math
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import fitz
 import string
 import unicodedata
@@ -120,6 +122,36 @@ WHATSAPP_PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID")
 WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
 ADMIN_WHATSAPP = os.getenv("ADMIN_WHATSAPP", "").strip()
 
+class _GraphRetry(Retry):
+    """
+    POST do Graph API (/messages, /media) não é idempotente: um 5xx/timeout depois do Meta aceitar
+    reenviaria o documento ao paciente. POST só repete em 429 (e em falha de conexão, antes do envio).
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method == "POST" and status_code != 429:
+            return False
+        return super().is_retry(method, status_code, has_retry_after=has_retry_after)
+
+
+# Sessão única para o Graph API (app.py reaproveita): keep-alive + reuso da sessão TLS
+# entre upload -> envio e entre pacientes; retry curto para 429/5xx (5xx só em GET).
+WHATSAPP_SESSION = requests.Session()
+WHATSAPP_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=_GraphRetry(
+        total=2,
+        read=0,  # timeout de leitura: o pedido pode já ter sido processado
+        backoff_factor=0.2,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "POST"}),
+        raise_on_status=False,
+    ),
+))
+if WHATSAPP_TOKEN:
+    WHATSAPP_SESSION.headers["Authorization"] = f"Bearer {WHATSAPP_TOKEN.strip()}"
+
 # ======================================================
 # =============== PDF PARSING ===========================
 # ======================================================
@@ -1774,7 +1806,8 @@ def analyze_pdf(
 def _headers() -> dict:
     if not WHATSAPP_TOKEN:
         raise RuntimeError("WHATSAPP_TOKEN not configured")
-    return {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
+    # Authorization já vai nos headers da WHATSAPP_SESSION
+    return {"Content-Type": "application/json"}
 
 def _endpoint() -> str:
     if not WHATSAPP_PHONE_NUMBER_ID:
@@ -1783,7 +1816,7 @@ def _endpoint() -> str:
 
 def _post_whatsapp(payload: dict) -> Optional[str]:
     try:
-        resp = requests.post(_endpoint(), headers=_headers(), json=payload, timeout=30)
+        resp = WHATSAPP_SESSION.post(_endpoint(), headers=_headers(), json=payload, timeout=30)
         if resp.status_code not in (200, 201):
             try:
                 data = resp.json()
@@ -1794,10 +1827,12 @@ def _post_whatsapp(payload: dict) -> Optional[str]:
     except Exception as e:
         return f"WA request failed: {e}"
 
+_NON_DIGITS_RE = re.compile(r"\D+")
+
 def normalize_phone(msisdn: str) -> str:
     if not msisdn:
         return msisdn
-    digits = re.sub(r"\D", "", msisdn)
+    digits = _NON_DIGITS_RE.sub("", msisdn)
     if not digits:
         return ""
 